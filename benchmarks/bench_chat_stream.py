@@ -0,0 +1,166 @@
+"""
+Chat streaming benchmark for Neko, fully offline.
+
+Drives the real chat path (ChatExecutor, ChatHistory, StreamingReply and
+the UI mailbox drained once per frame) against a MockBackend, in process or
+through a MockChatServer over TCP, or against a recorded cassette, and
+records:
+  - time to first token and total reply time (p50/p95/p99)
+  - streamed characters per second
+  - UI flushes per reply against chunks per reply
+  - failed replies and the largest prompt sent
+
+    python benchmarks/bench_chat_stream.py --turns 50 --latency 0.2 --tokens-per-s 80
+    python benchmarks/bench_chat_stream.py --turns 50 --server --error-rate 0.1 --seed 1
+    python benchmarks/bench_chat_stream.py --cassette session.jsonl
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+sys.path.insert(0, REPO_ROOT)
+
+from desktop_cat import StreamingReply, UI_FRAME_MS, UI_BUDGET_MS, UiMailbox  # noqa: E402
+from neko_chat import ChatExecutor, ChatHistory, estimate_tokens, percentile  # noqa: E402
+from neko_mock import MockBackend, MockChatServer, RemoteBackend  # noqa: E402
+from neko_cassette import ReplayBackend  # noqa: E402
+
+
+class ThreadTimer:
+    """TkTimer stand-in for a loop that calls UiMailbox.drain() itself; after() is never needed."""
+
+    def now(self):
+        return time.perf_counter()
+
+    def after(self, delay_ms, callback):
+        return None
+
+    def after_cancel(self, timer_id):
+        pass
+
+
+def start_server(backend):
+    """Runs a MockChatServer on its own loop thread and returns its port."""
+    loop = asyncio.new_event_loop()
+    server = MockChatServer(backend)
+    threading.Thread(target=loop.run_forever, name="mock-server", daemon=True).start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    return server.port
+
+
+def run_benchmark(args):
+    mock = MockBackend(
+        latency_s=args.latency,
+        jitter_s=args.jitter,
+        tokens_per_s=args.tokens_per_s,
+        chunk_tokens=args.chunk_tokens,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    if args.cassette:
+        backend = ReplayBackend(args.cassette, speed=args.speed)
+    elif args.server:
+        backend = RemoteBackend(port=start_server(mock))
+    else:
+        backend = mock
+    executor = ChatExecutor(max_pending=4, default_timeout=60.0)
+    history = ChatHistory(
+        lambda summary, turns: backend.generate(history.fold_prompt(summary, turns)),
+        max_tokens=args.history_tokens,
+    )
+    mailbox = UiMailbox(ThreadTimer(), interval_ms=UI_FRAME_MS, budget_ms=UI_BUDGET_MS)
+    results = {"ttft_ms": [], "total_ms": [], "chars": 0, "flushes": [], "chunks": [], "failures": 0,
+               "prompt_tokens": []}
+
+    async def respond(message, reply, counts):
+        contents = history.build(message)
+        results["prompt_tokens"].append(sum(
+            estimate_tokens(part) for content in history.memory() + contents for part in content["parts"]
+        ))
+        parts = []
+        async for text in backend.stream(contents, history.memory()):
+            parts.append(text)
+            counts["chunks"] += 1
+            if reply.add_chunk(text):
+                mailbox.post(flush, reply, counts)
+        history.record(message, "".join(parts))
+
+    def flush(reply, counts):
+        counts["flushes"] += 1
+        reply.take()
+
+    started = time.perf_counter()
+    for turn in range(args.turns):
+        reply = StreamingReply()
+        counts = {"chunks": 0, "flushes": 0}
+        request = executor.submit(lambda: respond(f"message {turn}: do you want tuna?", reply, counts))
+        request.future.add_done_callback(lambda future: reply.finish(error=future.exception()))
+        # The "Tk thread": one drain per frame until the reply is complete
+        while not reply.done:
+            time.sleep(UI_FRAME_MS / 1000.0)
+            mailbox.drain()
+        mailbox.drain()
+        if reply.error is not None:
+            results["failures"] += 1
+            continue
+        results["ttft_ms"].append(reply.ttft_ms)
+        results["total_ms"].append(reply.total_ms)
+        results["chars"] += len(reply.text)
+        results["flushes"].append(counts["flushes"])
+        results["chunks"].append(counts["chunks"])
+    wall_s = time.perf_counter() - started
+    executor.shutdown()
+
+    replies = len(results["total_ms"])
+    return {
+        "backend": backend.name,
+        "turns": args.turns,
+        "failures": results["failures"],
+        "ttft_p50_ms": percentile(results["ttft_ms"], 0.50),
+        "ttft_p95_ms": percentile(results["ttft_ms"], 0.95),
+        "ttft_p99_ms": percentile(results["ttft_ms"], 0.99),
+        "total_p50_ms": percentile(results["total_ms"], 0.50),
+        "total_p95_ms": percentile(results["total_ms"], 0.95),
+        "chars_per_s": results["chars"] / wall_s if wall_s else None,
+        "flushes_per_reply": sum(results["flushes"]) / replies if replies else None,
+        "chunks_per_reply": sum(results["chunks"]) / replies if replies else None,
+        "prompt_tokens_max": max(results["prompt_tokens"], default=None),
+        "history_folds": history.folds,
+        "wall_time_s": wall_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.2, help="mock seconds to the first chunk")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--tokens-per-s", type=float, default=80.0)
+    parser.add_argument("--chunk-tokens", type=int, default=4)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--history-tokens", type=int, default=4000)
+    parser.add_argument("--server", action="store_true", help="go through a MockChatServer over TCP")
+    parser.add_argument("--cassette", default=None, help="replay this recorded session instead of the mock")
+    parser.add_argument("--speed", type=float, default=1.0, help="cassette replay speed-up (0: no waiting)")
+    parser.add_argument("--output", default=None, help="where to write the JSON result")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print(json.dumps(result, indent=2))
+    output = args.output or os.path.join(RESULTS_DIR, f"chat-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Frame-timing benchmark for Neko.
+
+Launches DesktopPetApp under a private Xvfb server, lets it run for a while
+and records:
+  - import time of desktop_cat, the cost of DesktopPetApp.__init__ (first
+    stage asset loading included), time to the first frame and to all clips
+  - wall and CPU time of the whole staged startup, reported on their own
+  - per-tick lateness of the frame scheduler (p50/p95/p99/max)
+  - CPU time per hour of wall time and peak RSS
+  - render calls issued/skipped
+
+Lateness and CPU are measured over `--duration` seconds that start once the
+second startup stage (remaining clips, chat warm-up) has finished, so they
+describe the animation loop rather than one-off imports. The chat backend
+defaults to the in-process mock (NEKO_CHAT_BACKEND=mock) so no Gemini client
+is built.
+
+Results are written as JSON. Pass --baseline to compare against a stored
+result; the script exits with status 1 if any metric regressed past its
+threshold.
+
+    python benchmarks/bench_frame_timing.py --duration 60 --save-baseline
+    python benchmarks/bench_frame_timing.py --duration 60 --baseline benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+# metric -> (allowed ratio to baseline, absolute slack below which changes are noise)
+THRESHOLDS = {
+    "import_ms": (1.25, 50.0),
+    "init_ms": (1.25, 20.0),
+    "asset_load_ms": (1.25, 10.0),
+    "first_frame_ms": (1.25, 20.0),
+    "time_to_first_frame_ms": (1.25, 20.0),
+    "startup_cpu_s": (1.25, 0.2),
+    "lateness_p95_ms": (1.5, 5.0),
+    "lateness_p99_ms": (1.5, 10.0),
+    "cpu_s_per_hour": (1.25, 5.0),
+    "rss_peak_kb": (1.2, 4096.0),
+}
+
+
+def start_xvfb(screen="1920x1080x24"):
+    """Starts Xvfb on the first free display and returns (process, display)."""
+    if shutil.which("Xvfb") is None:
+        sys.exit("Xvfb not found; install it (e.g. apt install xvfb) or pass --no-xvfb")
+    for number in range(99, 199):
+        if os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        display = f":{number}"
+        process = subprocess.Popen(
+            ["Xvfb", display, "-screen", "0", screen, "-nolisten", "tcp"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        socket_path = f"/tmp/.X11-unix/X{number}"
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                return process, display
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+        process.kill()
+    sys.exit("Could not start Xvfb")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(duration_s, power_mode, startup_timeout_s=60.0):
+    os.chdir(REPO_ROOT)  # resource_path() resolves assets relative to the working directory
+    sys.path.insert(0, REPO_ROOT)
+    os.environ.setdefault("NEKO_CHAT_BACKEND", "mock")
+
+    import_start = time.perf_counter()
+    import desktop_cat
+    import_ms = (time.perf_counter() - import_start) * 1000
+
+    import tkinter as tk
+
+    root = tk.Tk()
+    init_cpu_start = time.process_time()
+    init_start = time.perf_counter()
+    app = desktop_cat.DesktopPetApp(root, power_mode=power_mode)
+    init_ms = (time.perf_counter() - init_start) * 1000
+
+    scheduler = app.engine.scheduler
+    lateness = []
+    first_frame = []
+    tick = scheduler.callback
+
+    window = {}  # cpu_start / wall_start of the measured window, once startup is over
+
+    def recording_tick(frames):
+        if not first_frame:
+            first_frame.append((time.perf_counter() - init_start) * 1000)
+        if window:
+            lateness.append(scheduler.last_lateness_ms)
+        tick(frames)
+
+    scheduler.callback = recording_tick
+
+    def wait_for_startup():
+        started = app.full_asset_load_ms is not None and app._gemini_ready.is_set()
+        if not started and time.perf_counter() - init_start < startup_timeout_s:
+            root.after(20, wait_for_startup)
+            return
+        window["cpu_start"] = time.process_time()
+        window["wall_start"] = time.perf_counter()
+        root.after(int(duration_s * 1000), root.quit)
+
+    root.after(20, wait_for_startup)
+    root.mainloop()
+    wall_s = time.perf_counter() - window["wall_start"]
+    cpu_s = time.process_time() - window["cpu_start"]
+    startup_ms = (window["wall_start"] - init_start) * 1000
+    startup_cpu_s = window["cpu_start"] - init_cpu_start
+
+    result = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "tk": tk.TkVersion,
+            "duration_s": round(wall_s, 3),
+            "power_mode": app.power_mode,
+            "chat_backend": app.chat_backend.name if app.chat_backend is not None else None,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "import_ms": round(import_ms, 2),
+        "init_ms": round(init_ms, 2),
+        "asset_load_ms": round(app.asset_load_ms, 2),
+        "first_frame_ms": round(first_frame[0], 2) if first_frame else None,
+        "time_to_first_frame_ms": round(app.time_to_first_frame_ms, 2) if app.time_to_first_frame_ms else None,
+        "full_asset_load_ms": round(app.full_asset_load_ms, 2) if app.full_asset_load_ms else None,
+        "startup_ms": round(startup_ms, 2),
+        "startup_cpu_s": round(startup_cpu_s, 3),
+        "ticks": scheduler.ticks,
+        "frames_skipped": scheduler.frames_skipped,
+        "fps": round(scheduler.fps, 2),
+        "lateness_mean_ms": round(sum(lateness) / len(lateness), 3) if lateness else 0.0,
+        "lateness_p50_ms": round(percentile(lateness, 0.50), 3),
+        "lateness_p95_ms": round(percentile(lateness, 0.95), 3),
+        "lateness_p99_ms": round(percentile(lateness, 0.99), 3),
+        "lateness_max_ms": round(max(lateness), 3) if lateness else 0.0,
+        "cpu_s_per_hour": round(cpu_s / wall_s * 3600, 3) if wall_s else 0.0,
+        "rss_peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "render_calls_issued": app.renderer.calls_issued,
+        "render_calls_skipped": app.renderer.calls_skipped,
+    }
+    app.quit_app()
+    return result
+
+
+def compare(result, baseline):
+    """Returns a list of human readable regressions (empty if none)."""
+    regressions = []
+    for metric, (ratio, slack) in THRESHOLDS.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if old is None or new is None:
+            continue
+        if new > old * ratio and new - old > slack:
+            regressions.append(f"{metric}: {old} -> {new} (allowed x{ratio}, +{slack})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to let Neko run")
+    parser.add_argument("--power-mode", default=None, help="full, adaptive or suspend")
+    parser.add_argument("--output", default=None, help="where to write the JSON result")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help=f"also write the result to {DEFAULT_BASELINE}")
+    parser.add_argument("--no-xvfb", action="store_true", help="use the current $DISPLAY instead of a private Xvfb")
+    args = parser.parse_args()
+
+    xvfb = None
+    if not args.no_xvfb:
+        xvfb, display = start_xvfb()
+        os.environ["DISPLAY"] = display
+    try:
+        result = run_benchmark(args.duration, args.power_mode)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("frame_timing_%Y%m%d_%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Saved results to {output}")
+
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w", encoding="utf-8") as file:
+            json.dump(result, file, indent=2)
+        print(f"Saved baseline to {DEFAULT_BASELINE}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(result, baseline)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,34 @@
 import os
 import sys
+import ctypes
+import time
+
+# Taken before the heavy imports, so time-to-first-frame covers the whole startup
+PROCESS_START = time.perf_counter()
+
+import json
+import base64
+import heapq
 import random
+import argparse
+import functools
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
 import tkinter as tk
 from tkinter import scrolledtext
-import google.generativeai as genai  # <<< ADDED: Gemini library
+import queue
 import threading  # <<< ADDED: Library to run API calls in a separate thread to avoid blocking the GUI
-import customtkinter as ctk
 import csv  # <<< ADDED: For chat history saving
 import datetime  # <<< ADDED: For timestamps in chat history
+import asyncio
+
+from neko_chat import (
+    ChatExecutor, ChatHistory, ChatQueueFull, CircuitBreaker, GeminiBackend, HedgedBackend,
+    KeyPoolBackend, QuotaScheduler, ReplyCache, ResilientBackend, RoutedBackend,
+    keyed_gemini_client, percentile,
+)
 
 # --- Helper function for PyInstaller path handling ---
 def resource_path(relative_path):
@@ -21,80 +42,981 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-class DesktopPetApp:
+# --- Win32 bits used for the working area ---
+SPI_GETWORKAREA = 48
+WM_SETTINGCHANGE = 0x001A
+WM_DISPLAYCHANGE = 0x007E
+WM_DPICHANGED = 0x02E0
+
+
+class RECT(ctypes.Structure):
+    _fields_ = [("left", ctypes.c_long),
+                ("top", ctypes.c_long),
+                ("right", ctypes.c_long),
+                ("bottom", ctypes.c_long)]
+
+
+# --- GIF loading ---
+# Browsers treat a declared delay of 0 as "as fast as possible"; use a sane default.
+DEFAULT_FRAME_MS = 100
+
+GifFrame = namedtuple("GifFrame", "data delay")
+
+
+def split_gif_frames(data):
+    """
+    Splits an animated GIF into standalone single-frame GIFs in one pass.
+    Returns a list of GifFrame(data, delay) with the delay in milliseconds
+    taken from each frame's Graphic Control Extension.
+
+    Only the block structure is walked here (no LZW decoding), and every frame
+    keeps the original header and global colour table, so Tk decodes each frame
+    exactly once instead of re-reading the whole file for every 'gif -index'.
+    """
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("Not a GIF file")
+    flags = data[10]
+    pos = 13
+    if flags & 0x80:
+        pos += 3 * (2 << (flags & 0x07))
+    header = b"GIF89a" + data[6:pos]
+
+    def skip_sub_blocks(pos):
+        while data[pos]:
+            pos += data[pos] + 1
+        return pos + 1
+
+    frames = []
+    control = b""
+    while pos < len(data):
+        block = data[pos]
+        if block == 0x21:  # Extension
+            start = pos
+            label = data[pos + 1]
+            pos = skip_sub_blocks(pos + 2)
+            if label == 0xF9:  # Graphic Control Extension (delay, transparency)
+                control = data[start:pos]
+        elif block == 0x2C:  # Image descriptor
+            start = pos
+            local_flags = data[pos + 9]
+            pos += 10
+            if local_flags & 0x80:
+                pos += 3 * (2 << (local_flags & 0x07))
+            pos = skip_sub_blocks(pos + 1)  # +1 for the LZW minimum code size
+            delay = int.from_bytes(control[4:6], "little") * 10 if control else 0
+            frames.append(GifFrame(header + control + data[start:pos] + b"\x3b", delay or DEFAULT_FRAME_MS))
+            control = b""
+        elif block == 0x3B:  # Trailer
+            break
+        else:
+            raise ValueError(f"Corrupt GIF: unexpected block 0x{block:02x} at offset {pos}")
+    return frames
+
+
+def read_gif_frames(path):
+    """Reads a GIF once and returns its frames base64-encoded for tk.PhotoImage(data=...)."""
+    with open(path, "rb") as file:
+        data = file.read()
+    return [GifFrame(base64.b64encode(frame.data), frame.delay) for frame in split_gif_frames(data)]
+
+
+def load_gif_clips(paths, max_workers=None):
+    """
+    Parses every GIF in {clip name: path} on a worker pool.
+    Returns {clip name: [GifFrame]}; building the PhotoImages is left to the
+    Tk thread, since Tk objects can only be created there.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, len(paths))) as pool:
+        futures = {name: pool.submit(read_gif_frames, path) for name, path in paths.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# --- Animation manifest ---
+MANIFEST_PATH = "image/manifest.json"
+
+# A clip's precomputed timeline: frames, how long each one is shown (ms) and
+# the clip's length.
+AnimationClip = namedtuple("AnimationClip", "name frames delays duration")
+
+AnimationState = namedtuple("AnimationState", "name clip frames delays duration dx dy next_states suspend")
+
+# How hard Neko tries to save power (NEKO_POWER_MODE):
+#   "full"     - every frame at the delay the GIF declares
+#   "adaptive" - low-motion states use their "low_power_frame_ms" cadence
+#   "suspend"  - adaptive, and states marked "suspend" stop all timers after
+#                one playthrough until input or their scheduled wake-up
+POWER_MODES = ("full", "adaptive", "suspend")
+
+
+def load_animation_manifest(path=None):
+    """
+    Loads the animation manifest that sits next to the GIFs.
+
+    "clips" maps a clip name to its {"file": ...} inside image/. Frame counts
+    and delays are not listed; they are read from the GIF itself.
+    "states" maps a state name to {"clip", "move": [dx, dy] per frame,
+    "next": {state: weight}} plus an optional "frame_ms" that overrides the
+    delays declared by the GIF, a "low_power_frame_ms" used instead in the
+    adaptive power modes, and "suspend": true for states that may stop the
+    frame timer entirely. "initial_state" is where Neko starts.
+    """
+    path = path or resource_path(MANIFEST_PATH)
+    with open(path, "r", encoding="utf-8") as file:
+        manifest = json.load(file)
+    for key in ("clips", "states", "initial_state"):
+        if key not in manifest:
+            raise ValueError(f"Animation manifest {path} is missing '{key}'")
+    if manifest["initial_state"] not in manifest["states"]:
+        raise ValueError(f"Unknown initial state '{manifest['initial_state']}'")
+    return manifest
+
+
+def manifest_clip_paths(manifest, manifest_path=None):
+    """{clip name: absolute GIF path}, resolved relative to the manifest."""
+    base_dir = os.path.dirname(manifest_path or resource_path(MANIFEST_PATH))
+    return {name: os.path.join(base_dir, clip["file"]) for name, clip in manifest["clips"].items()}
+
+
+def build_clip_timeline(name, frames, delays):
+    """Precomputes the total duration for a clip's frame delays."""
+    return AnimationClip(name, tuple(frames), tuple(delays), sum(delays))
+
+
+def compile_animation_states(states, clips, power_mode="full"):
+    """
+    Compiles the manifest's states into a list of AnimationState tuples plus a
+    name -> index map. `clips` maps clip names to AnimationClip timelines.
+    next_states is expanded by weight into a tuple of indexes, so picking the
+    next state is a single rng.choice(). Frame delays are resolved for the
+    given power mode here, so the tick itself never has to look at it.
+    """
+    if power_mode not in POWER_MODES:
+        raise ValueError(f"Unknown power mode '{power_mode}', expected one of {POWER_MODES}")
+    index = {name: i for i, name in enumerate(states)}
+    compiled = []
+    for name, spec in states.items():
+        clip = clips.get(spec["clip"])
+        if clip is None:
+            raise ValueError(f"State '{name}' uses unknown clip '{spec['clip']}'")
+        if not clip.frames:
+            raise ValueError(f"Clip '{clip.name}' has no frames")
+        next_states = []
+        for target, weight in spec["next"].items():
+            if target not in index:
+                raise ValueError(f"State '{name}' transitions to unknown state '{target}'")
+            next_states.extend([index[target]] * int(weight))
+        if not next_states:
+            raise ValueError(f"State '{name}' has no next state")
+        delays = clip.delays
+        if spec.get("frame_ms"):
+            delays = (int(spec["frame_ms"]),) * len(clip.frames)
+        if power_mode != "full" and spec.get("low_power_frame_ms"):
+            delays = (int(spec["low_power_frame_ms"]),) * len(clip.frames)
+        suspend = power_mode == "suspend" and bool(spec.get("suspend"))
+        dx, dy = spec.get("move", (0, 0))
+        compiled.append(AnimationState(
+            name, clip, clip.frames, delays, sum(delays), dx, dy, tuple(next_states), suspend
+        ))
+    return compiled, index
+
+
+class PetRenderer:
+    """
+    Applies the pet's position and frame to the window, remembering what was
+    last applied so unchanged geometry or images don't cost a Tcl round trip.
+    """
+
+    def __init__(self, master, label, size=(100, 100)):
+        self.master = master
+        self.label = label
+        self.size = size
+        self.calls_issued = 0
+        self.calls_skipped = 0
+        self.first_frame_at = None  # perf_counter() of the first image shown
+        self._position = None
+        self._image = None
+
+    def move(self, x, y):
+        if self._position == (x, y):
+            self.calls_skipped += 1
+            return
+        self._apply_position(x, y)
+        self._position = (x, y)
+        self.calls_issued += 1
+
+    def show(self, frame):
+        if frame is self._image:
+            self.calls_skipped += 1
+            return
+        self._apply_image(frame)
+        self._image = frame
+        self.calls_issued += 1
+        if self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+
+    def render(self, x, y, frame):
+        self.move(x, y)
+        self.show(frame)
+
+    def _apply_position(self, x, y):
+        self.master.geometry(f'{self.size[0]}x{self.size[1]}+{x}+{y}')
+
+    def _apply_image(self, frame):
+        self.label.configure(image=frame)
+
+
+class HeadlessRenderer(PetRenderer):
+    """Counts the calls a PetRenderer would make without touching any window."""
+
+    def __init__(self, size=(100, 100)):
+        super().__init__(None, None, size)
+
+    def _apply_position(self, x, y):
+        pass
+
+    def _apply_image(self, frame):
+        pass
+
+
+# --- Clocks ---
+class TkTimer:
+    """Real time, with callbacks run by the Tk event loop."""
+
     def __init__(self, master):
+        self.master = master
+
+    def now(self):
+        return time.perf_counter()
+
+    def after(self, delay_ms, callback):
+        return self.master.after(delay_ms, callback)
+
+    def after_cancel(self, timer_id):
+        self.master.after_cancel(timer_id)
+
+
+class VirtualClock:
+    """
+    Simulated time with the same interface as TkTimer. Nothing runs on its own;
+    run_until() fires due callbacks in deadline order, jumping the clock forward
+    between them, so hours of behaviour replay as fast as the code can run.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._queue = []
+        self._ids = itertools.count(1)
+        self._cancelled = set()
+        self.callbacks_run = 0
+
+    def now(self):
+        return self._now
+
+    def after(self, delay_ms, callback):
+        timer_id = next(self._ids)
+        heapq.heappush(self._queue, (self._now + delay_ms / 1000.0, timer_id, callback))
+        return timer_id
+
+    def after_cancel(self, timer_id):
+        self._cancelled.add(timer_id)
+
+    def advance(self, seconds):
+        self.run_until(self._now + seconds)
+
+    def run_until(self, deadline):
+        while self._queue and self._queue[0][0] <= deadline:
+            due, timer_id, callback = heapq.heappop(self._queue)
+            if timer_id in self._cancelled:
+                self._cancelled.discard(timer_id)
+                continue
+            self._now = max(self._now, due)
+            self.callbacks_run += 1
+            callback()
+        self._now = max(self._now, deadline)
+
+
+class FrameScheduler:
+    """
+    Runs a tick callback against absolute deadlines on a timer (TkTimer for the
+    real app, VirtualClock for the headless simulator).
+
+    Each tick is scheduled relative to where the previous frame *should* have
+    fired rather than when it actually did, so lateness doesn't accumulate.
+    If the loop falls behind by a frame or two the scheduler catches up by
+    firing back-to-back; beyond max_lag frames it skips ahead and hands the
+    callback the number of frames that elapsed so movement stays correct.
+    """
+
+    def __init__(self, timer, callback, interval_ms=100, max_lag=3):
+        self.timer = timer
+        self.callback = callback
+        self.interval_ms = interval_ms
+        self.max_lag = max_lag
+
+        self.ticks = 0
+        self.frames_skipped = 0
+        self.last_lateness_ms = 0.0
+        self._active = False
+        self._deadline = None
+        self._after_id = None
+        self._history = deque(maxlen=32)  # (timestamp, frames advanced)
+
+    @property
+    def running(self):
+        return self._active
+
+    @property
+    def fps(self):
+        """Measured animation frames per second over the recent window (skips included)."""
+        if len(self._history) < 2:
+            return 0.0
+        span = self._history[-1][0] - self._history[0][0]
+        if span <= 0:
+            return 0.0
+        frames = sum(n for _, n in list(self._history)[1:])
+        return frames / span
+
+    def start(self, delay_ms=0):
+        self.stop()
+        self._active = True
+        self._deadline = self.timer.now() + delay_ms / 1000.0
+        self._schedule()
+
+    def stop(self):
+        self._active = False
+        if self._after_id is not None:
+            try:
+                self.timer.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    def _schedule(self):
+        delay = max(0, int(round((self._deadline - self.timer.now()) * 1000)))
+        self._after_id = self.timer.after(delay, self._run)
+
+    def _run(self):
+        self._after_id = None
+        now = self.timer.now()
+        interval = self.interval_ms / 1000.0
+        lateness = now - self._deadline
+        self.last_lateness_ms = lateness * 1000.0
+
+        frames = 1
+        missed = int(lateness // interval) if interval > 0 else 0
+        if missed > self.max_lag:
+            # Too far behind to catch up frame by frame: collapse the backlog
+            frames += missed
+            self.frames_skipped += missed
+            self._deadline += missed * interval
+
+        self.ticks += 1
+        self._history.append((now, frames))
+        try:
+            self.callback(frames)
+        finally:
+            # The callback may have changed interval_ms or stopped us
+            if self._active and self._after_id is None:
+                self._deadline += self.interval_ms / 1000.0
+                self._schedule()
+
+
+class UiMailbox:
+    """
+    The one way for background threads to hand results to the Tk thread.
+
+    post() only puts onto a queue.SimpleQueue, so any thread may call it; Tk
+    itself is never touched off its own thread. The Tk thread drains the queue
+    once per frame within a time budget. The pump only runs while background
+    work announced with begin() is outstanding, so an idle Neko has no timer.
+    """
+
+    def __init__(self, timer, interval_ms=33, budget_ms=8):
+        self.timer = timer
+        self.interval_ms = interval_ms
+        self.budget_ms = budget_ms
+        self.delivered = 0
+        self.deferred = 0  # Drains that ran out of budget and left work for the next frame
+        self._queue = queue.SimpleQueue()
+        self._outstanding = 0
+        self._after_id = None
+
+    def post(self, callback, *args):
+        """Any thread: run callback(*args) on the Tk thread at the next drain."""
+        self._queue.put((callback, args))
+
+    def begin(self):
+        """Tk thread: background work that will post back has started; keep draining."""
+        self._outstanding += 1
+        if self._after_id is None:
+            self._after_id = self.timer.after(self.interval_ms, self._pump)
+
+    def end(self):
+        """Tk thread: one piece of work announced with begin() has delivered its last message."""
+        self._outstanding = max(0, self._outstanding - 1)
+
+    def drain(self):
+        """
+        Runs the messages that were queued when the drain started, stopping
+        early once the budget is spent. Messages posted meanwhile wait for the
+        next frame, so a chatty producer can't keep the Tk thread here.
+        """
+        deadline = time.perf_counter() + self.budget_ms / 1000.0
+        for _ in range(self._queue.qsize()):
+            try:
+                callback, args = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"UI callback {getattr(callback, '__name__', callback)} failed: {e}")
+            self.delivered += 1
+            if time.perf_counter() > deadline:
+                if not self._queue.empty():
+                    self.deferred += 1
+                break
+
+    def close(self):
+        if self._after_id is not None:
+            self.timer.after_cancel(self._after_id)
+            self._after_id = None
+        self._outstanding = 0
+
+    def _pump(self):
+        self._after_id = None
+        self.drain()
+        if self._outstanding or not self._queue.empty():
+            self._after_id = self.timer.after(self.interval_ms, self._pump)
+
+
+class PetEngine:
+    """
+    Neko's behaviour: the state machine, movement, frame timing and sleep
+    suspension. It only talks to a timer, a renderer and a bounds callable,
+    so the same code drives the Tk window and the headless simulator.
+    """
+
+    def __init__(self, states, state_index, initial_state, timer, renderer, bounds, rng=None, x=0, y=0):
+        self.states = states
+        self.state_index = state_index
+        self.timer = timer
+        self.renderer = renderer
+        self.bounds = bounds  # () -> (max_x, max_y), cached by the caller
+        self.rng = rng or random.Random()
+
+        self.state = states[state_index[initial_state]]
+        self.cycle = 0
+        self.x = x
+        self.y = y
+        self.dragging = False
+        self.looped = False
+        self.frame_delay = self.state.delays[0]
+
+        # Counted in frame delays, so time is charged to the state whose frame was on screen
+        self.dwell_ms = dict.fromkeys(state_index, 0.0)
+        self._wake_id = None
+        self._wake_at = None
+        self._wake_state = None
+        self.scheduler = FrameScheduler(timer, self.update, interval_ms=self.frame_delay)
+
+    @property
+    def suspended(self):
+        return self._wake_id is not None
+
+    def start(self, delay_ms=0):
+        self.scheduler.start(delay_ms)
+
+    def stop(self):
+        self.scheduler.stop()
+        if self._wake_id is not None:
+            self._cancel_wake()
+
+    def set_state(self, name):
+        if name not in self.state_index:
+            return  # Not loaded yet (staged startup)
+        self.state = self.states[self.state_index[name]]
+        self.cycle = 0
+
+    def replace_states(self, states, state_index):
+        """Swaps in a new compiled table; the current state carries over by name."""
+        self.states = states
+        self.state_index = state_index
+        self.state = states[state_index[self.state.name]]
+        for name in state_index:
+            self.dwell_ms.setdefault(name, 0.0)
+
+    def move_to(self, x, y):
+        self.x = x
+        self.y = y
+
+    def clamp(self):
+        """Clamp x/y into the bounds; pure integer work, the bounds are cached."""
+        max_x, max_y = self.bounds()
+        self.x = 0 if self.x < 0 else max_x if self.x > max_x else self.x
+        self.y = 0 if self.y < 0 else max_y if self.y > max_y else self.y
+
+    def dwell_times(self):
+        """Milliseconds of animation each state has been on screen for so far."""
+        return dict(self.dwell_ms)
+
+    def update(self, frames=1):
+        """
+        Advances the animation by `frames` ticks and shows the resulting frame.
+        Called by the FrameScheduler; frames > 1 means the loop fell behind.
+        """
+        if not self.dragging:
+            for _ in range(frames):
+                frame = self._advance()
+        else:
+            frame = self.state.frames[self.cycle]
+
+        # Only touches Tk when the position or frame actually changed
+        self.renderer.render(self.x, self.y, frame)
+        self.scheduler.interval_ms = self.frame_delay
+
+        if self.looped and self.state.suspend and not self.dragging:
+            self._suspend()
+
+    def _advance(self):
+        """Steps the current state one frame and returns the frame to display."""
+        state = self.state
+        frame = state.frames[self.cycle]
+        self.frame_delay = state.delays[self.cycle]
+        self.dwell_ms[state.name] += self.frame_delay
+        if state.dx or state.dy:
+            self.x += state.dx
+            self.y += state.dy
+            # Clamp instead of raw wrap-around so Neko won't go out of screen
+            self.clamp()
+        self.cycle += 1
+        self.looped = False
+        if self.cycle >= len(state.frames):
+            self.cycle = 0
+            self.state = self.states[self.rng.choice(state.next_states)]
+            self.looped = self.state is state
+        return frame
+
+    def _suspend(self):
+        """
+        Stops the frame timer while a still state (sleep) loops. How many more
+        loops the state machine would have stayed in it is sampled up front, so
+        a single timer wakes Neko exactly when it would have moved on.
+        """
+        state = self.state
+        own_index = self.state_index[state.name]
+        loops = 1
+        next_index = self.rng.choice(state.next_states)
+        while next_index == own_index:
+            loops += 1
+            next_index = self.rng.choice(state.next_states)
+
+        # The frame _advance just showed stays up for its own delay (already
+        # counted in dwell_ms) before the remaining loops begin
+        sleep_ms = self.frame_delay + loops * state.duration
+        self.scheduler.stop()
+        self._wake_state = self.states[next_index]
+        self._wake_at = self.timer.now() + sleep_ms / 1000.0
+        self._wake_id = self.timer.after(sleep_ms, self._wake)
+        self.dwell_ms[state.name] += loops * state.duration
+
+    def _wake(self):
+        """Scheduled end of a suspension: carry on with the state sampled in _suspend."""
+        self._wake_id = None
+        self.state = self._wake_state
+        self.cycle = 0
+        self.looped = False
+        self.scheduler.start()
+
+    def resume(self):
+        """Input while suspended: animate again right away, still in the current state."""
+        if self._wake_id is None:
+            return
+        self._cancel_wake()
+        self.looped = False
+        self.scheduler.start()
+
+    def _cancel_wake(self):
+        self.timer.after_cancel(self._wake_id)
+        self._wake_id = None
+        # The rest of the sleep that was charged up front won't happen now
+        self.dwell_ms[self.state.name] -= max(0.0, self._wake_at - self.timer.now()) * 1000.0
+
+
+def run_headless_simulation(hours=24.0, seed=None, power_mode="adaptive", screen=(1920, 1080)):
+    """
+    Replays Neko's behaviour without a window on a VirtualClock with a seeded
+    RNG. Frames are the raw GIF data, so clip lengths and delays are the real
+    ones. Returns a report of state dwell times, timer wakeups and the Tk calls
+    the real app would have issued.
+    """
+    wall_start = time.perf_counter()
+    manifest = load_animation_manifest()
+    encoded_clips = load_gif_clips(manifest_clip_paths(manifest))
+    clips = {
+        name: build_clip_timeline(name, [frame.data for frame in frames], [frame.delay for frame in frames])
+        for name, frames in encoded_clips.items()
+    }
+    states, state_index = compile_animation_states(manifest["states"], clips, power_mode)
+
+    clock = VirtualClock()
+    renderer = HeadlessRenderer()
+    # Same layout as the app's fallback: 50px taskbar, 100x100 pet
+    bounds = (max(0, screen[0] - 100), max(0, screen[1] - 50 - 100))
+    engine = PetEngine(
+        states, state_index, manifest["initial_state"], clock, renderer, lambda: bounds,
+        rng=random.Random(seed), x=bounds[0] // 2, y=bounds[1],
+    )
+    engine.start()
+    clock.run_until(hours * 3600.0)
+    engine.stop()  # Gives back the part of a sleep in progress that lies past the end
+
+    simulated_s = clock.now()
+    return {
+        "hours": hours,
+        "seed": seed,
+        "power_mode": power_mode,
+        "dwell_s": {name: round(ms / 1000.0, 3) for name, ms in engine.dwell_times().items()},
+        "ticks": engine.scheduler.ticks,
+        "timer_wakeups": clock.callbacks_run,
+        "wakeups_per_hour": round(clock.callbacks_run / (simulated_s / 3600.0), 1) if simulated_s else 0.0,
+        "render_calls_issued": renderer.calls_issued,
+        "render_calls_skipped": renderer.calls_skipped,
+        "wall_time_s": round(time.perf_counter() - wall_start, 3),
+    }
+
+
+class ChatTranscript:
+    """
+    View model for the chat box. Each message is a range in the Text widget
+    that starts at a mark named msg<id> and whose content carries the tag
+    msg<id>, so appending to or replacing one message only touches
+    that range instead of re-reading and re-inserting the whole transcript.
+
+    Only the newest max_visible messages live in the widget. Older ones stay
+    in the model and are paged back in when the user scrolls to the top.
+    """
+
+    def __init__(self, widget, max_visible=200, page_size=50):
+        self.widget = widget
+        self.max_visible = max_visible
+        self.page_size = page_size
+        self.messages = {}  # id -> [text, separator]
+        self.order = []  # message ids, oldest first
+        self._first_visible = 0  # position in self.order of the oldest message in the widget
+        self._ids = itertools.count(1)
+
+    def add(self, text, separator="\n"):
+        """Appends a new message and returns its id."""
+        msg_id = next(self._ids)
+        self.messages[msg_id] = [text, separator]
+        self.order.append(msg_id)
+        follow = self._at_bottom()
+        with self._editable():
+            self._insert(msg_id, self.widget.index("end-1c"))
+            if follow:
+                self._trim()
+        if follow:
+            self.widget.see("end")
+        return msg_id
+
+    def append(self, msg_id, text):
+        """Appends text to an existing message (e.g. a streaming reply)."""
+        self.messages[msg_id][0] += text
+        if not self._is_visible(msg_id):
+            return
+        follow = self._at_bottom()
+        with self._editable():
+            self.widget.insert(self._content_end(msg_id), text, (f"msg{msg_id}",))
+        if follow:
+            self.widget.see("end")
+
+    def replace(self, msg_id, text):
+        self.messages[msg_id][0] = text
+        if not self._is_visible(msg_id):
+            return
+        mark = f"msg{msg_id}"
+        with self._editable():
+            self.widget.delete(mark, self._content_end(msg_id))
+            self.widget.insert(mark, text, (mark,))
+
+    def on_scroll(self):
+        """Call after the view scrolled; pages older messages in once the top is reached."""
+        if self._first_visible and self.widget.yview()[0] <= 0.0:
+            self.page_older()
+
+    def page_older(self):
+        """Puts the previous page of messages back at the top, keeping the view where it was."""
+        if not self._first_visible:
+            return
+        start = max(0, self._first_visible - self.page_size)
+        anchor = f"msg{self.order[self._first_visible]}"
+        # The anchor sits exactly where the older messages go; let it move right past them
+        self.widget.mark_gravity(anchor, "right")
+        with self._editable():
+            index = "1.0"
+            for msg_id in self.order[start:self._first_visible]:
+                self._insert(msg_id, index)
+                index = anchor
+        self.widget.mark_gravity(anchor, "left")
+        self._first_visible = start
+        self.widget.yview(anchor)
+
+    def _insert(self, msg_id, index):
+        text, separator = self.messages[msg_id]
+        mark = f"msg{msg_id}"
+        self.widget.mark_set(mark, index)
+        self.widget.mark_gravity(mark, "left")
+        self.widget.insert(mark, text, (mark,))
+        self.widget.insert(self._content_end(msg_id), separator)
+
+    def _delete(self, msg_id, position):
+        mark = f"msg{msg_id}"
+        if position + 1 < len(self.order):
+            end = f"msg{self.order[position + 1]}"
+        else:
+            end = "end-1c"
+        self.widget.delete(mark, end)
+        self.widget.mark_unset(mark)
+        self.widget.tag_delete(mark)
+
+    def _trim(self):
+        while len(self.order) - self._first_visible > self.max_visible:
+            self._delete(self.order[self._first_visible], self._first_visible)
+            self._first_visible += 1
+
+    def _content_end(self, msg_id):
+        ranges = self.widget.tag_ranges(f"msg{msg_id}")
+        return ranges[-1] if ranges else f"msg{msg_id}"
+
+    def _position(self, msg_id):
+        # Edits are almost always to the newest messages, so search from the end
+        for position in range(len(self.order) - 1, -1, -1):
+            if self.order[position] == msg_id:
+                return position
+        raise KeyError(msg_id)
+
+    def _is_visible(self, msg_id):
+        return self._position(msg_id) >= self._first_visible
+
+    def _at_bottom(self):
+        return self.widget.yview()[1] >= 0.999
+
+    @contextlib.contextmanager
+    def _editable(self):
+        self.widget.configure(state="normal")
+        try:
+            yield
+        finally:
+            self.widget.configure(state="disabled")
+
+
+class StreamingReply:
+    """
+    A Gemini reply being streamed by a worker thread. The worker appends
+    chunks as they arrive and only needs to post a flush to the UI mailbox
+    when add_chunk() returns True; the Tk thread then takes everything that
+    arrived since its last look, so a long reply costs one Text insert per
+    frame instead of one per chunk. Time-to-first-token and total latency are
+    kept apart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self.parts = []
+        self.done = False
+        self.error = None
+        self._done_taken = False
+        self.typing_id = None  # Transcript message ids, only touched on the Tk thread
+        self.message_id = None
+        self.cache_key = None  # ReplyCache key, when the reply cache is on
+        self.cached = False
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+    def add_chunk(self, text):
+        """Returns True if the UI isn't due to look at this reply yet and needs a flush posted."""
+        with self._lock:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            notify = not self._pending
+            self._pending.append(text)
+        return notify
+
+    def finish(self, error=None):
+        with self._lock:
+            self.error = error
+            self.done = True
+            self.finished_at = time.perf_counter()
+
+    def take(self):
+        """
+        Returns (text received since the last call, finished); finished is
+        True exactly once, on the first take() after finish().
+        """
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+            done = self.done and not self._done_taken
+            if done:
+                self._done_taken = True
+        if text:
+            self.parts.append(text)
+        return text, done
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def ttft_ms(self):
+        return None if self.first_token_at is None else (self.first_token_at - self.started_at) * 1000
+
+    @property
+    def total_ms(self):
+        return None if self.finished_at is None else (self.finished_at - self.started_at) * 1000
+
+
+# Staged startup: delay before the background stage starts
+STARTUP_DEFER_MS = 50
+GEMINI_SETUP_TIMEOUT_S = 30
+# While background work is outstanding the UI mailbox is drained every
+# UI_FRAME_MS, spending at most UI_BUDGET_MS per drain
+UI_FRAME_MS = 33
+UI_BUDGET_MS = 8
+# Messages kept in the chat widget, and how many older ones come back per scroll to the top
+TRANSCRIPT_MAX_VISIBLE = 200
+TRANSCRIPT_PAGE_SIZE = 50
+# Shown (and saved) in place of a reply that came back without any text
+EMPTY_REPLY_TEXT = "..."
+# Chat requests waiting at most, and how long one may take including its queueing time
+CHAT_QUEUE_SIZE = 4
+CHAT_REQUEST_TIMEOUT_S = 60
+# Messages sent within this long of each other go to the model as one turn
+CHAT_DEBOUNCE_MS = 300
+# Model calls: overall deadline (also the gRPC deadline), the longest wait for a
+# first chunk or between chunks, attempts for retryable errors, and the circuit
+# breaker that fails fast when the API is down or we're offline
+CHAT_DEADLINE_S = 45
+CHAT_ATTEMPT_TIMEOUT_S = 20
+CHAT_MAX_ATTEMPTS = 3
+BREAKER_FAILURES = 4
+BREAKER_RESET_S = 30
+# Token budget for the conversation sent with each message (NEKO_HISTORY_TOKENS);
+# older turns are folded into a summary that gets CHAT_SUMMARY_TOKENS of it
+CHAT_HISTORY_TOKENS = 4000
+CHAT_SUMMARY_TOKENS = 400
+GEMINI_MODEL = "gemini-2.5-flash"
+# Seconds the persona and chat summary stay in a Gemini context cache
+# (NEKO_CONTEXT_CACHE_TTL); 0 sends them with every message instead
+CONTEXT_CACHE_TTL_S = 0
+# Optional hedging (NEKO_HEDGE_MODEL=<model>): when GEMINI_MODEL's first token is
+# later than this percentile of its recent ones, the turn also goes to the hedge model
+HEDGE_PERCENTILE = 0.95
+# Optional routing (NEKO_ROUTE_MODELS=<model>,<model>...): small talk goes to the
+# fastest of these whose p95 first token and error rate meet the SLO; long or
+# complex prompts go to NEKO_STRONG_MODEL
+GEMINI_STRONG_MODEL = "gemini-2.5-pro"
+ROUTE_SLO_TTFT_S = 1.5
+ROUTE_MAX_ERROR_RATE = 0.2
+STATS_REFRESH_MS = 1000
+# Gemini quotas per minute (NEKO_QUOTA_RPM / NEKO_QUOTA_TPM; 0 lifts that limit, both 0
+# turns the scheduler off); chat turns get them before summaries
+QUOTA_RPM = 10
+QUOTA_TPM = 250000
+# Opt-in cache of replies to repeated prompts (NEKO_REPLY_CACHE=1)
+REPLY_CACHE_SIZE = 256
+REPLY_CACHE_TTL_S = 7 * 24 * 3600
+
+
+class DesktopPetApp:
+    def __init__(self, master, power_mode=None):
         """
         Initializes the Desktop Pet application.
         """
         self.master = master
+        self.power_mode = power_mode or os.getenv("NEKO_POWER_MODE", "adaptive")
         self.master.config(highlightbackground='black')
         self.master.overrideredirect(True)
-        self.master.wm_attributes('-transparentcolor', 'black')
+        try:
+            self.master.wm_attributes('-transparentcolor', 'black')
+        except tk.TclError:
+            # Only Windows supports a transparent colour key (e.g. not under X11/Xvfb)
+            pass
         self.master.wm_attributes('-topmost', True)
 
         # Ensure geometry info is up-to-date
         self.master.update_idletasks()
 
-        screen_width = self.master.winfo_screenwidth()
-        screen_height = self.master.winfo_screenheight()
-        
-        # Calculate position accounting for taskbar and scaling
-        # Get the actual working area (excludes taskbar)
-        try:
-            import ctypes
-            from ctypes import wintypes
-            
-            # Get working area (screen minus taskbar)
-            class RECT(ctypes.Structure):
-                _fields_ = [("left", ctypes.c_long),
-                           ("top", ctypes.c_long),
-                           ("right", ctypes.c_long),
-                           ("bottom", ctypes.c_long)]
-            
-            rect = RECT()
-            ctypes.windll.user32.SystemParametersInfoW(48, 0, ctypes.byref(rect), 0)  # SPI_GETWORKAREA
-            
-            working_height = rect.bottom - rect.top
-            working_width = rect.right - rect.left
-            
-            # Position Neko on the taskbar (just above working area)
-            self.x = working_width // 2 - 50
-            self.y = working_height - 100  # 100px from bottom of working area (on taskbar)
-            
-        except Exception as e:
-            print(f"Could not get working area, using fallback positioning: {e}")
-            # Fallback: assume standard taskbar height of about 40-50px
-            taskbar_height = 50
-            self.x = screen_width // 2 - 50
-            self.y = screen_height - taskbar_height - 100  # Position above taskbar
+        # Screen metrics used by clamping; cached and dropped only when the
+        # display, DPI, taskbar or pet size changes (see _invalidate_screen_metrics)
+        self._work_area = None
+        self._pet_size = None
+        self._clamp_bounds = None
 
-        # Ensure initial position is clamped to the visible area
-        self.cycle = 0
-        self.check = 0
-        self.idle_num = [1, 2, 3, 4]
-        self.sleep_num = [10, 11, 12, 13, 15]
-        self.walk_left_num = [6, 7]
-        self.walk_right_num = [8, 9]
-        self.event_number = random.randrange(1, 3, 1)
-
-        self.is_dragging = False
         self.drag_start_x = 0
         self.drag_start_y = 0
         self.chat_window = None
+        self.stats_window = None
         self.chat_history_file = os.path.join(os.path.dirname(__file__), "chat_history", "neko_chat_history.csv")  # <<< MODIFIED: Single file
         self.current_session_messages = []  # <<< ADDED: Store messages for current session
         self.session_start_time = None  # <<< ADDED: Track when session started
 
-        # Load GIF frames
-        self.idle = [tk.PhotoImage(file=resource_path('image/idle.gif'), format='gif -index %i' % (i)) for i in range(5)]
-        self.idle_to_sleep = [tk.PhotoImage(file=resource_path('image/idle_to_sleep.gif'), format='gif -index %i' % (i)) for i in range(8)]
-        self.sleep = [tk.PhotoImage(file=resource_path('image/sleep.gif'), format='gif -index %i' % (i)) for i in range(3)]
-        self.sleep_to_idle = [tk.PhotoImage(file=resource_path('image/sleep_to_idle.gif'), format='gif -index %i' % (i)) for i in range(8)]
-        self.walk_positive = [tk.PhotoImage(file=resource_path('image/walking_positive.gif'), format='gif -index %i' % (i)) for i in range(8)]
-        self.walk_negative = [tk.PhotoImage(file=resource_path('image/walking_negative.gif'), format='gif -index %i' % (i)) for i in range(8)]
+        # Staged startup: only the clip Neko starts in is loaded before the first
+        # frame. The other clips, customtkinter and the Gemini client follow in
+        # the background (see _start_background_loading).
+        load_start = time.perf_counter()
+        self.manifest = load_animation_manifest()
+        self.clip_paths = manifest_clip_paths(self.manifest)
+        initial_state = self.manifest["initial_state"]
+        initial_spec = self.manifest["states"][initial_state]
+        self.clips = self._build_clips(load_gif_clips({initial_spec["clip"]: self.clip_paths[initial_spec["clip"]]}))
+        # Until everything is loaded Neko just stays in the initial state
+        boot_states = {initial_state: dict(initial_spec, move=[0, 0], next={initial_state: 1})}
+        self.states, self.state_index = compile_animation_states(boot_states, self.clips, self.power_mode)
+        self.asset_load_ms = (time.perf_counter() - load_start) * 1000
+        self.full_asset_load_ms = None
+        self.time_to_first_frame_ms = None
+        self._background = ThreadPoolExecutor(max_workers=1)
+        self.mailbox = UiMailbox(TkTimer(self.master), interval_ms=UI_FRAME_MS, budget_ms=UI_BUDGET_MS)
+        self._gemini_ready = threading.Event()
+        self.chat_backend = None
+        self.quota_scheduler = None
+        self.chat_history = ChatHistory(
+            self._summarize_history,
+            max_tokens=int(os.getenv("NEKO_HISTORY_TOKENS", CHAT_HISTORY_TOKENS)),
+            summary_tokens=CHAT_SUMMARY_TOKENS,
+        )
+        self.reply_cache = None
+        if os.getenv("NEKO_REPLY_CACHE") == "1":
+            self.reply_cache = ReplyCache(
+                os.path.join(os.path.dirname(self.chat_history_file), "neko_reply_cache.json"),
+                max_entries=REPLY_CACHE_SIZE,
+                ttl_s=REPLY_CACHE_TTL_S,
+            )
+        self._last_neko_reply = ""  # Context for reply cache keys
+        self._outbox = []  # User messages not sent to the model yet
+        self._debounce_id = None
+        self._active_reply = None
+        self.reply_timings = deque(maxlen=50)  # (time to first token ms, total ms) of recent replies
+        # One long-lived asyncio thread serialises every Gemini call
+        self.chat_executor = ChatExecutor(max_pending=CHAT_QUEUE_SIZE, default_timeout=CHAT_REQUEST_TIMEOUT_S)
 
         self.label = tk.Label(self.master, bd=0, bg='black')
         self.label.pack()
+        self.renderer = PetRenderer(self.master, self.label)
+        self.label.bind("<Configure>", self._on_label_configure)
+        self._watch_display_changes()
+
+        # Position Neko on the taskbar (just above the working area, which excludes the taskbar)
+        working_width, working_height = self._get_working_area()
+        self.engine = PetEngine(
+            self.states, self.state_index, initial_state,
+            TkTimer(self.master), self.renderer, self._get_clamp_bounds,
+            x=working_width // 2 - 50, y=working_height - 100,
+        )
 
         self.label.bind("<ButtonPress-1>", self.on_drag_start)
         self.label.bind("<B1-Motion>", self.on_drag_motion)
@@ -103,27 +1025,139 @@ class DesktopPetApp:
         self.create_context_menu()
         self.label.bind("<Button-3>", self.show_context_menu)
 
-        # <<< ADDED: Initialize the Gemini chatbot
-        self.setup_gemini_chatbot()
+        # Any interaction wakes Neko up if the frame timer is suspended
+        for sequence in ("<Enter>", "<ButtonPress-1>", "<Button-3>"):
+            self.label.bind(sequence, lambda event: self.engine.resume(), add="+")
 
         # Make sure initial position is valid
-        self._clamp_position()
+        self.engine.clamp()
+        self.engine.start(delay_ms=1)
+        self.master.after(STARTUP_DEFER_MS, self._start_background_loading)
+
+    def _build_clips(self, encoded_clips):
+        """Turns parsed GIFs into AnimationClips; PhotoImages must be built on the Tk thread."""
+        return {
+            name: build_clip_timeline(
+                name,
+                [tk.PhotoImage(data=frame.data, format='gif') for frame in frames],
+                [frame.delay for frame in frames],
+            )
+            for name, frames in encoded_clips.items()
+        }
+
+    def _start_background_loading(self):
+        """Second startup stage, kicked off once the first frame is up."""
+        remaining = {name: path for name, path in self.clip_paths.items() if name not in self.clips}
+        self.mailbox.begin()
+        self._background.submit(self._load_remaining_clips, remaining)
+
+        # <<< ADDED: Initialize the Gemini chatbot (off the Tk thread, it imports a lot)
+        threading.Thread(target=self._warm_up_chat, daemon=True).start()
+
+    def _load_remaining_clips(self, paths):
+        """Background thread: parses the GIFs and posts the result (or the error) to the Tk thread."""
+        try:
+            result = load_gif_clips(paths)
+        except Exception as e:
+            result = e
+        self.mailbox.post(self._finish_loading_assets, result)
+
+    def _finish_loading_assets(self, encoded_clips):
+        """Tk thread: builds the remaining PhotoImages and swaps in the full state table."""
+        self.mailbox.end()
+        try:
+            if isinstance(encoded_clips, Exception):
+                raise encoded_clips
+            self.clips.update(self._build_clips(encoded_clips))
+            self.states, self.state_index = compile_animation_states(
+                self.manifest["states"], self.clips, self.power_mode
+            )
+        except Exception as e:
+            print(f"Could not load animations, Neko will stay idle: {e}")
+            return
+        self.engine.replace_states(self.states, self.state_index)
+        self.full_asset_load_ms = (time.perf_counter() - PROCESS_START) * 1000
+        if self.renderer.first_frame_at is not None:
+            self.time_to_first_frame_ms = (self.renderer.first_frame_at - PROCESS_START) * 1000
+            print(f"First frame after {self.time_to_first_frame_ms:.1f} ms, "
+                  f"all {sum(len(clip.frames) for clip in self.clips.values())} frames after {self.full_asset_load_ms:.1f} ms")
+
+    def _warm_up_chat(self):
+        """Background thread: heavy chat imports and the Gemini client, so the first chat is instant."""
+        try:
+            import customtkinter  # noqa: F401 -- only to have it imported before the chat window opens
+        except Exception as e:
+            print(f"Could not import customtkinter: {e}")
+        try:
+            self.setup_chat_backend()
+        finally:
+            self._gemini_ready.set()
 
-        self.master.after(1, self.update)
+    def setup_chat_backend(self):
+        """
+        Picks the chat backend from NEKO_CHAT_BACKEND: "gemini" (default),
+        "mock" for an in-process fake model, "mock://host:port" for a mock
+        server started with neko_mock.py, or "replay://path" to replay a
+        cassette. NEKO_CASSETTE_RECORD=path records whichever is chosen.
+        """
+        choice = os.getenv("NEKO_CHAT_BACKEND", "gemini")
+        if choice == "gemini":
+            self.setup_gemini_chatbot()
+        else:
+            try:
+                from neko_mock import MockBackend, RemoteBackend
+                from neko_cassette import ReplayBackend
+                if choice == "mock":
+                    self.chat_backend = MockBackend()
+                elif choice.startswith("mock://"):
+                    self.chat_backend = RemoteBackend.from_url(choice)
+                elif choice.startswith("replay://"):
+                    self.chat_backend = ReplayBackend(choice[len("replay://"):])
+                else:
+                    raise ValueError(f"unknown chat backend {choice!r}")
+                print(f"Neko is chatting through the {self.chat_backend.name} backend")
+            except Exception as e:
+                print(f"Unable to initialize the chat backend: {e}")
+                self.chat_backend = None
+
+        cassette = os.getenv("NEKO_CASSETTE_RECORD")
+        if cassette and self.chat_backend is not None:
+            from neko_cassette import RecordingBackend
+            self.chat_backend = RecordingBackend(self.chat_backend, cassette)
+            print(f"Recording chat interactions to {cassette}")
+        if self.chat_backend is not None:
+            self.chat_backend = ResilientBackend(
+                self.chat_backend,
+                deadline_s=CHAT_DEADLINE_S,
+                attempt_timeout_s=CHAT_ATTEMPT_TIMEOUT_S,
+                max_attempts=CHAT_MAX_ATTEMPTS,
+                breaker=CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_S),
+                scheduler=self.quota_scheduler,
+            )
 
     def setup_gemini_chatbot(self):
         """
         Configures and initializes the Gemini model for conversation.
         """
         try:
-            api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-            if not api_key:
-                print("Error: Please set the GEMINI_API_KEY or GOOGLE_API_KEY environment variable.")
-                # Keep the app running but disable chat if no API key
-                self.gemini_chat = None
-                return
+            api_keys = []
+            if os.getenv("NEKO_GEMINI_OFFLINE") == "1":
+                # Local stand-in: chat works without an API key or network
+                from neko_mock import OfflineGenAI
+                genai = OfflineGenAI()
+            else:
+                import google.generativeai as genai  # <<< ADDED: Gemini library (imported lazily, it is slow)
+                # A pool of keys (NEKO_GEMINI_API_KEYS=key1,key2,...) spreads requests over their quotas
+                api_keys = [key.strip() for key in os.getenv("NEKO_GEMINI_API_KEYS", "").split(",") if key.strip()]
+                if not api_keys and (os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")):
+                    api_keys = [os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")]
+                if not api_keys:
+                    print("Error: Please set the GEMINI_API_KEY or GOOGLE_API_KEY environment variable.")
+                    # Keep the app running but disable chat if no API key
+                    self.chat_backend = None
+                    return
 
-            genai.configure(api_key=api_key)
+                genai.configure(api_key=api_keys[0])
 
             # This is the "soul" of the pet, replacing the old dictionary
             system_instruction = (
@@ -134,43 +1168,82 @@ class DesktopPetApp:
                 "Never say you are an AI model or a language model. You are a cat."
             )
 
-            model = genai.GenerativeModel(
-                model_name="gemini-2.5-flash",
-                system_instruction=system_instruction
-            )
-            self.gemini_chat = model.start_chat()
+            # No ChatSession: the conversation is rebuilt from self.chat_history on
+            # every message, so the request size stays bounded however long Neko runs
+            cache_ttl_s = int(os.getenv("NEKO_CONTEXT_CACHE_TTL", CONTEXT_CACHE_TTL_S))
+
+            # Quotas are per key, so a key pool gets the sum of them. The scheduler admits each
+            # attempt (ResilientBackend) and each hedge before its timers start, so queueing for
+            # quota is never mistaken for a slow model.
+            requests_per_min = int(os.getenv("NEKO_QUOTA_RPM", QUOTA_RPM))
+            tokens_per_min = int(os.getenv("NEKO_QUOTA_TPM", QUOTA_TPM))
+            if requests_per_min > 0 or tokens_per_min > 0:
+                key_count = max(1, len(api_keys))
+                self.quota_scheduler = QuotaScheduler(
+                    max(0, requests_per_min) * key_count, max(0, tokens_per_min) * key_count
+                )
+
+            def make_backend(model_name):
+                if len(api_keys) < 2:
+                    return GeminiBackend(genai, model_name, system_instruction, cache_ttl_s=cache_ttl_s)
+                # The first key is the globally configured one. Context caches are created
+                # through the global client, so only that key's backend may use them.
+                backends = [GeminiBackend(genai, model_name, system_instruction, cache_ttl_s=cache_ttl_s)]
+                for key in api_keys[1:]:
+                    backends.append(GeminiBackend(
+                        genai, model_name, system_instruction,
+                        client_factory=functools.partial(keyed_gemini_client, key),
+                    ))
+                return KeyPoolBackend(backends, requests_per_min=max(0, requests_per_min))
+
+            route_models = [name.strip() for name in os.getenv("NEKO_ROUTE_MODELS", "").split(",") if name.strip()]
+            if route_models:
+                self.chat_backend = RoutedBackend(
+                    [make_backend(name) for name in route_models],
+                    make_backend(os.getenv("NEKO_STRONG_MODEL", GEMINI_STRONG_MODEL)),
+                    slo_ttft_s=ROUTE_SLO_TTFT_S,
+                    max_error_rate=ROUTE_MAX_ERROR_RATE,
+                )
+            else:
+                self.chat_backend = make_backend(GEMINI_MODEL)
+            hedge_model = os.getenv("NEKO_HEDGE_MODEL")
+            if hedge_model:
+                self.chat_backend = HedgedBackend(
+                    self.chat_backend, make_backend(hedge_model),
+                    percentile=HEDGE_PERCENTILE, scheduler=self.quota_scheduler,
+                )
             print("Gemini Chatbot (Neko) is ready!")
 
         except Exception as e:
             print(f"Unable to initialize Gemini: {e}")
-            self.gemini_chat = None
+            self.chat_backend = None
 
     def on_drag_start(self, event):
-        self.is_dragging = True
+        self.engine.dragging = True
         self.drag_start_x = event.x
         self.drag_start_y = event.y
 
     def on_drag_motion(self, event):
-        if self.is_dragging:
+        if self.engine.dragging:
             new_x = self.master.winfo_x() + (event.x - self.drag_start_x)
             new_y = self.master.winfo_y() + (event.y - self.drag_start_y)
             # Update visually while dragging; final clamp will apply on release
-            self.master.geometry(f'+{new_x}+{new_y}')
-            self.x = new_x
-            self.y = new_y
+            self.engine.move_to(new_x, new_y)
+            self.renderer.move(new_x, new_y)
 
     def on_drag_release(self, event):
-        self.is_dragging = False
+        self.engine.dragging = False
         # Ensure the pet doesn't end up outside the visible area after user drags it
-        self._clamp_position()
-        self.master.geometry(f'100x100+{self.x}+{self.y}')
+        self.engine.clamp()
+        self.renderer.move(self.engine.x, self.engine.y)
 
     def create_context_menu(self):
         self.context_menu = tk.Menu(self.master, tearoff=0)
         self.context_menu.add_command(label="Chat with Neko", command=self.open_chat_window)
-        self.context_menu.add_command(label="Make Neko Sleep", command=lambda: self.set_animation_event(5))
-        self.context_menu.add_command(label="Make Neko Walk Left", command=lambda: self.set_animation_event(6))
-        self.context_menu.add_command(label="Make Neko Walk Right", command=lambda: self.set_animation_event(8))
+        self.context_menu.add_command(label="Make Neko Sleep", command=lambda: self.engine.set_state("idle_to_sleep"))
+        self.context_menu.add_command(label="Make Neko Walk Left", command=lambda: self.engine.set_state("walk_left"))
+        self.context_menu.add_command(label="Make Neko Walk Right", command=lambda: self.engine.set_state("walk_right"))
+        self.context_menu.add_command(label="Chat Stats", command=self.open_stats_window)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Quit Neko", command=self.quit_app)
 
@@ -180,76 +1253,6 @@ class DesktopPetApp:
         finally:
             self.context_menu.grab_release()
 
-    def set_animation_event(self, new_event_number):
-        self.event_number = new_event_number
-        self.cycle = 0
-
-    def event(self):
-        if self.event_number in self.idle_num:
-            self.check = 0
-            self.master.after(400, self.update)
-        elif self.event_number == 5:
-            self.check = 1
-            self.master.after(100, self.update)
-        elif self.event_number in self.walk_left_num:
-            self.check = 4
-            self.master.after(100, self.update)
-        elif self.event_number in self.walk_right_num:
-            self.check = 5
-            self.master.after(100, self.update)
-        elif self.event_number in self.sleep_num:
-            self.check = 2
-            self.master.after(1000, self.update)
-        elif self.event_number == 14:
-            self.check = 3
-            self.master.after(100, self.update)
-
-    def gif_work(self, frames, first_num, last_num):
-        if self.cycle < len(frames) - 1:
-            self.cycle += 1
-        else:
-            self.cycle = 0
-            self.event_number = random.randrange(first_num, last_num + 1, 1)
-        return self.cycle, self.event_number
-
-    def update(self):
-        if not self.is_dragging:
-            if self.check == 0:
-                frame = self.idle[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.idle, 1, 9)
-            elif self.check == 1:
-                frame = self.idle_to_sleep[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.idle_to_sleep, 10, 10)
-            elif self.check == 2:
-                frame = self.sleep[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.sleep, 10, 15)
-            elif self.check == 3:
-                frame = self.sleep_to_idle[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.sleep_to_idle, 1, 1)
-            elif self.check == 4:
-                frame = self.walk_positive[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.walk_positive, 1, 9)
-                self.x -= 3
-                # Clamp instead of raw wrap-around so Neko won't go out of screen
-                self._clamp_position()
-            elif self.check == 5:
-                frame = self.walk_negative[self.cycle]
-                self.cycle, self.event_number = self.gif_work(self.walk_negative, 1, 9)
-                self.x += 3
-                self._clamp_position()
-        else:
-            if self.check == 0: frame = self.idle[self.cycle]
-            elif self.check == 1: frame = self.idle_to_sleep[self.cycle]
-            elif self.check == 2: frame = self.sleep[self.cycle]
-            elif self.check == 3: frame = self.sleep_to_idle[self.cycle]
-            elif self.check == 4: frame = self.walk_positive[self.cycle]
-            elif self.check == 5: frame = self.walk_negative[self.cycle]
-
-        # Apply geometry (keep window size fixed to 100x100 as before)
-        self.master.geometry(f'100x100+{self.x}+{self.y}')
-        self.label.configure(image=frame)
-        self.master.after(1, self.event)
-
     def open_chat_window(self):
         if self.chat_window is not None and self.chat_window.winfo_exists():
             self.chat_window.lift()
@@ -258,6 +1261,8 @@ class DesktopPetApp:
         # <<< ADDED: Create new chat history file for this session
         self._create_new_chat_session()
         
+        import customtkinter as ctk
+
         # Theme setup
         ctk.set_appearance_mode("dark")   # "dark", "light", "system"
         ctk.set_default_color_theme("blue")  # "blue", "green", "dark-blue"
@@ -281,6 +1286,9 @@ class DesktopPetApp:
         )
         self.chat_display.configure(state="disabled")
         self.chat_display.pack(padx=10, pady=10, fill="both", expand=True)
+        self.transcript = ChatTranscript(self.chat_display, TRANSCRIPT_MAX_VISIBLE, TRANSCRIPT_PAGE_SIZE)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Prior>"):
+            self.chat_display.bind(sequence, lambda event: self.chat_window.after_idle(self.transcript.on_scroll))
 
         # Khung nhập tin nhắn + nút send
         input_frame = ctk.CTkFrame(self.chat_window)
@@ -359,73 +1367,220 @@ class DesktopPetApp:
 
 
     def send_chat_message(self):
-        """Handles sending the user message to Gemini in a separate thread."""
+        """
+        Shows the user's message at once and queues it for Neko. The input stays
+        live: messages sent in quick succession, or while Neko is still
+        replying, go to the model together as one turn.
+        """
         user_message = self.user_input_entry.get().strip()
         if not user_message:
             return
 
         # Hiển thị tin nhắn user
-        self._insert_chat_message(f"You: {user_message}\n")
+        self.transcript.add(f"You: {user_message}")
         self.user_input_entry.delete(0, tk.END)
         
         # <<< ADDED: Save user message to history
         self._save_message_to_history("User", user_message)
 
-        # Tạm disable input
-        self.user_input_entry.configure(state="disabled")
-        self.send_button.configure(state="disabled")
-        self._insert_chat_message("Neko is typing...\n\n")
+        self._outbox.append(user_message)
+        if self._active_reply is None:
+            # Wait a moment in case more is on its way
+            if self._debounce_id is not None:
+                self.chat_window.after_cancel(self._debounce_id)
+            self._debounce_id = self.chat_window.after(CHAT_DEBOUNCE_MS, self._dispatch_outbox)
+
+    def _dispatch_outbox(self):
+        """Sends everything queued as one turn, unless a reply is still on its way."""
+        self._debounce_id = None
+        if self._active_reply is not None or not self._outbox:
+            return
+        user_message = "\n".join(self._outbox)
+        self._outbox.clear()
 
-        # Tạo thread để gọi API
-        thread = threading.Thread(target=self._get_gemini_response, args=(user_message,))
-        thread.daemon = True
-        thread.start()
+        reply = self._active_reply = StreamingReply()
+        if self.reply_cache is not None:
+            reply.cache_key = self.reply_cache.key(user_message, self._last_neko_reply)
+            cached = self.reply_cache.get(reply.cache_key)
+            if cached is not None:
+                # Answered on the spot; the history still has to hear about it
+                reply.cached = True
+                reply.add_chunk(cached)
+                reply.finish()
+                self.chat_executor.call_soon(self.chat_history.record, user_message, cached)
+                self.mailbox.begin()
+                self._flush_reply(reply)
+                return
 
-    def _get_gemini_response(self, user_message):
-        """Gọi Gemini API trong thread riêng."""
+        # Gửi yêu cầu tới chat executor; results come back through the UI mailbox
+        reply.typing_id = self.transcript.add("Neko is typing...", "\n\n")
+        self.mailbox.begin()
         try:
-            if not self.gemini_chat:
-                raise RuntimeError("Gemini is not initialized.")
-            response = self.gemini_chat.send_message(user_message)
-            neko_response = response.text
-        except Exception as e:
-            neko_response = f"Meow... (Error: {e})"
-
-        # Gửi kết quả về main thread
-        self.master.after(0, self._update_chat_with_response, neko_response)
-
-    def _update_chat_with_response(self, neko_response):
-        """Cập nhật chat box với câu trả lời từ Neko."""
-        # Xoá dòng "Neko is typing..."
-        self.chat_display.configure(state="normal")
-        content = self.chat_display.get("1.0", "end")
-        if "Neko is typing..." in content:
-            new_content = content.replace("Neko is typing...\n\n", "")
-            self.chat_display.delete("1.0", "end")
-            self.chat_display.insert("1.0", new_content)
-        self.chat_display.configure(state="disabled")
+            request = self.chat_executor.submit(lambda: self._get_gemini_response(user_message, reply))
+        except (ChatQueueFull, RuntimeError) as e:
+            reply.finish(error=e)
+            self.mailbox.post(self._flush_reply, reply)
+        else:
+            request.future.add_done_callback(lambda future: self._on_request_done(future, reply))
+
+    async def _get_gemini_response(self, user_message, reply):
+        """Runs on the chat executor's loop; chunks are handed to `reply` as they stream in."""
+        # The client is set up in the background at startup; wait for it on the first message
+        if not self._gemini_ready.is_set():
+            await asyncio.to_thread(self._gemini_ready.wait, GEMINI_SETUP_TIMEOUT_S)
+        if not self.chat_backend:
+            raise RuntimeError("Gemini is not initialized.")
+
+        contents = self.chat_history.build(user_message)
+        parts = []
+        async for text in self.chat_backend.stream(contents, self.chat_history.memory()):
+            parts.append(text)
+            if reply.add_chunk(text):
+                self.mailbox.post(self._flush_reply, reply)
+        # Only complete exchanges make it into the history
+        self.chat_history.record(user_message, "".join(parts))
+
+    async def _summarize_history(self, summary, turns):
+        """Chat loop, in the background: folds old turns into the running summary."""
+        return await self.chat_backend.generate(self.chat_history.fold_prompt(summary, turns))
+
+    def _on_request_done(self, future, reply):
+        """Executor thread (or the cancelling thread): marks the reply finished."""
+        if future.cancelled():
+            reply.finish(error=RuntimeError("cancelled"))
+        else:
+            reply.finish(error=future.exception())
+        self.mailbox.post(self._flush_reply, reply)
+
+    def _flush_reply(self, reply):
+        """Tk thread (via the mailbox): appends whatever streamed in since the last flush."""
+        first = not reply.parts
+        text, done = reply.take()
+        if done:
+            self.mailbox.end()
+        if reply is not self._active_reply:
+            return  # The chat window was closed meanwhile
+        if text:
+            if first:
+                self._start_reply_message(reply, text)
+            else:
+                self.transcript.append(reply.message_id, text)
+        if not done:
+            return
+
+        if reply.error is not None:
+            error_text = f"Meow... (Error: {reply.error})"
+            if reply.parts:
+                self.transcript.append(reply.message_id, f" {error_text}")
+            else:
+                self._start_reply_message(reply, error_text)
+            neko_response = (reply.text + " " + error_text).strip()
+        else:
+            neko_response = reply.text
+            if not reply.parts:
+                # The model answered with nothing at all; don't leave "typing..." behind
+                neko_response = EMPTY_REPLY_TEXT
+                self._start_reply_message(reply, neko_response)
+            if reply.cached:
+                print(f"Neko replied from the reply cache (hit rate {self.reply_cache.hit_rate:.0%})")
+            else:
+                self.reply_timings.append((reply.ttft_ms, reply.total_ms))
+                print(f"Neko replied: first token after {reply.ttft_ms or 0:.0f} ms, complete after {reply.total_ms:.0f} ms")
+                if reply.cache_key is not None and reply.text:
+                    self.reply_cache.put(reply.cache_key, neko_response)
+        self._last_neko_reply = neko_response
+        self._active_reply = None
 
-        # Thêm câu trả lời thật
-        self._insert_chat_message(f"Neko: {neko_response}\n\n")
-        
         # <<< ADDED: Save Neko's response to history
         self._save_message_to_history("Neko", neko_response)
 
-        # Bật lại input
-        self.user_input_entry.configure(state="normal")
-        self.send_button.configure(state="normal")
-        self.user_input_entry.focus_set()
+        # Whatever the user sent meanwhile has waited long enough
+        self._dispatch_outbox()
 
-    def _insert_chat_message(self, message: str):
-        """Thêm tin nhắn vào chat box."""
-        self.chat_display.configure(state="normal")
-        self.chat_display.insert("end", message)
-        self.chat_display.see("end")  # luôn cuộn xuống cuối
-        self.chat_display.configure(state="disabled")
+    def _start_reply_message(self, reply, text):
+        """Turns the typing indicator into Neko's actual message, in place."""
+        if reply.typing_id is not None:
+            self.transcript.replace(reply.typing_id, f"Neko: {text}")
+            reply.message_id = reply.typing_id
+        else:
+            reply.message_id = self.transcript.add(f"Neko: {text}", "\n\n")
+
+    def open_stats_window(self):
+        """Debug view: routing decision, per-model latency and the other chat counters, refreshed live."""
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.lift()
+            return
+        self.stats_window = tk.Toplevel(self.master)
+        self.stats_window.title("Neko chat stats")
+        self.stats_window.attributes("-topmost", True)
+        label = tk.Label(self.stats_window, justify="left", anchor="nw", font=("Consolas", 9), padx=10, pady=10)
+        label.pack(fill="both", expand=True)
+        self._refresh_stats_window(label)
+
+    def _refresh_stats_window(self, label):
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            self.stats_window = None
+            return
+        # The backends and the history belong to the chat loop: snapshot them there
+        self.mailbox.begin()
+        self.chat_executor.call_soon(self._collect_chat_stats, label)
+        self.stats_window.after(STATS_REFRESH_MS, self._refresh_stats_window, label)
+
+    def _collect_chat_stats(self, label):
+        """Chat loop: snapshot of the stats only the loop may read, posted to the Tk thread."""
+        try:
+            sections = {
+                "history": {
+                    "turns kept": len(self.chat_history.turns),
+                    "summary folds": self.chat_history.folds,
+                },
+            }
+            if self.chat_backend is not None:
+                sections.update(self.chat_backend.stats())
+        except Exception as e:
+            sections = {"stats": {"error": str(e)}}
+        self.mailbox.post(self._show_chat_stats, label, sections)
+
+    def _show_chat_stats(self, label, loop_sections):
+        self.mailbox.end()
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            return
+        label.configure(text=self._format_chat_stats(loop_sections))
+
+    def _format_chat_stats(self, loop_sections):
+        ttfts = [ttft for ttft, total in self.reply_timings if ttft is not None]
+        sections = {
+            "replies": {
+                "backend": self.chat_backend.name if self.chat_backend else None,
+                "ttft p50 ms": round(percentile(ttfts, 0.50)) if ttfts else None,
+                "ttft p95 ms": round(percentile(ttfts, 0.95)) if ttfts else None,
+                "total p95 ms": round(percentile([total for ttft, total in self.reply_timings], 0.95))
+                if self.reply_timings else None,
+                "queued": self.chat_executor.pending,
+            },
+        }
+        if self.reply_cache is not None:
+            sections["reply cache"] = {"entries": len(self.reply_cache), "hit rate": f"{self.reply_cache.hit_rate:.0%}"}
+        sections.update(loop_sections)
+        lines = []
+        for section, values in sections.items():
+            lines.append(f"[{section}]")
+            for name, value in values.items():
+                if isinstance(value, float):
+                    value = f"{value:.2f}"
+                lines.append(f"  {name:<22} {value}")
+        return "\n".join(lines)
 
     def _on_chat_window_close(self):
         """Handle chat window close event - save the complete session."""
+        if self._debounce_id is not None:
+            self.chat_window.after_cancel(self._debounce_id)
+            self._debounce_id = None
+        self._outbox.clear()
+        self._active_reply = None
+        self.chat_executor.cancel_all()
         self._save_complete_session()
+        self._save_reply_cache()
         self.chat_window.destroy()
         self.chat_window = None
 
@@ -433,30 +1588,35 @@ class DesktopPetApp:
         """Legacy method - now calls the proper close handler."""
         self._on_chat_window_close()
 
+    def _save_reply_cache(self):
+        if self.reply_cache is None:
+            return
+        try:
+            self.reply_cache.save()
+        except OSError as e:
+            print(f"Could not save the reply cache: {e}")
+
     def quit_app(self):
+        self._save_reply_cache()
+        self.engine.stop()
+        self.mailbox.close()
+        self._background.shutdown(wait=False, cancel_futures=True)
+        self.chat_executor.shutdown()
         self.master.destroy()
 
     # ------------------ New helper methods for clamping & sizes ------------------
     def _get_working_area(self):
         """Get the working area (screen minus taskbar) dimensions."""
-        try:
-            import ctypes
-            from ctypes import wintypes
-            
-            class RECT(ctypes.Structure):
-                _fields_ = [("left", ctypes.c_long),
-                           ("top", ctypes.c_long),
-                           ("right", ctypes.c_long),
-                           ("bottom", ctypes.c_long)]
-            
-            rect = RECT()
-            ctypes.windll.user32.SystemParametersInfoW(48, 0, ctypes.byref(rect), 0)  # SPI_GETWORKAREA
-            
-            return rect.right - rect.left, rect.bottom - rect.top
-        except Exception:
-            # Fallback to screen size minus estimated taskbar
-            screen_w, screen_h = self._get_screen_size()
-            return screen_w, screen_h - 50  # Assume 50px taskbar
+        if self._work_area is None:
+            try:
+                rect = RECT()
+                ctypes.windll.user32.SystemParametersInfoW(SPI_GETWORKAREA, 0, ctypes.byref(rect), 0)
+                self._work_area = (rect.right - rect.left, rect.bottom - rect.top)
+            except Exception:
+                # Fallback to screen size minus estimated taskbar
+                screen_w, screen_h = self._get_screen_size()
+                self._work_area = (screen_w, screen_h - 50)  # Assume 50px taskbar
+        return self._work_area
 
     def _get_screen_size(self):
         self.master.update_idletasks()
@@ -464,46 +1624,99 @@ class DesktopPetApp:
 
     def _get_pet_size(self):
         """Try to determine the pet window / label size; fall back to 100x100 if unknown."""
+        if self._pet_size is not None:
+            return self._pet_size
         self.master.update_idletasks()
         pet_w, pet_h = 100, 100
         try:
             mw = self.master.winfo_width()
             mh = self.master.winfo_height()
-            if mw > 0:
+            if mw > 1:
                 pet_w = mw
-            if mh > 0:
+            if mh > 1:
                 pet_h = mh
             lw = self.label.winfo_width()
             lh = self.label.winfo_height()
-            if lw > 0:
+            if lw > 1:
                 pet_w = lw
-            if lh > 0:
+            if lh > 1:
                 pet_h = lh
         except Exception:
             pass
-        return pet_w, pet_h
+        self._pet_size = (pet_w, pet_h)
+        return self._pet_size
+
+    def _on_label_configure(self, event):
+        """The label reports its new size itself, so no layout pass is needed to re-measure."""
+        if event.width > 1 and event.height > 1 and (event.width, event.height) != self._pet_size:
+            self._pet_size = (event.width, event.height)
+            self._clamp_bounds = None
+
+    def _invalidate_screen_metrics(self):
+        self._work_area = None
+        self._pet_size = None
+        self._clamp_bounds = None
 
-    def _clamp_position(self):
-        """Clamp self.x/self.y so the pet stays inside the working area (excludes taskbar)."""
-        working_w, working_h = self._get_working_area()
-        pet_w, pet_h = self._get_pet_size()
+    def _watch_display_changes(self):
+        """
+        Hooks the pet window's message loop (Windows only) so resolution, DPI and
+        taskbar changes drop the cached working area instead of polling it.
+        """
+        try:
+            comctl32 = ctypes.windll.comctl32
+            SUBCLASSPROC = ctypes.WINFUNCTYPE(
+                ctypes.c_ssize_t, ctypes.c_void_p, ctypes.c_uint,
+                ctypes.c_size_t, ctypes.c_ssize_t, ctypes.c_size_t, ctypes.c_size_t
+            )
+            comctl32.DefSubclassProc.restype = ctypes.c_ssize_t
+            comctl32.DefSubclassProc.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_size_t, ctypes.c_ssize_t]
+            comctl32.SetWindowSubclass.argtypes = [ctypes.c_void_p, SUBCLASSPROC, ctypes.c_size_t, ctypes.c_size_t]
 
-        min_x, max_x = 0, max(0, working_w - pet_w)
-        min_y, max_y = 0, max(0, working_h - pet_h)
+            def window_proc(hwnd, msg, wparam, lparam, subclass_id, ref_data):
+                if msg in (WM_DISPLAYCHANGE, WM_DPICHANGED) or (msg == WM_SETTINGCHANGE and wparam == 0x002F):  # SPI_SETWORKAREA
+                    self._invalidate_screen_metrics()
+                return comctl32.DefSubclassProc(hwnd, msg, wparam, lparam)
 
-        self.x = max(min_x, min(self.x, max_x))
-        self.y = max(min_y, min(self.y, max_y))
+            # Keep a reference, otherwise the callback is garbage collected while Windows still calls it
+            self._window_proc = SUBCLASSPROC(window_proc)
+            hwnd = int(self.master.wm_frame(), 16)
+            comctl32.SetWindowSubclass(hwnd, self._window_proc, 1, 0)
+        except Exception as e:
+            print(f"Display change notifications unavailable, screen metrics stay cached: {e}")
+
+    def _get_clamp_bounds(self):
+        """Largest x/y that keeps the pet inside the working area (excludes taskbar)."""
+        if self._clamp_bounds is None:
+            working_w, working_h = self._get_working_area()
+            pet_w, pet_h = self._get_pet_size()
+            self._clamp_bounds = (max(0, working_w - pet_w), max(0, working_h - pet_h))
+        return self._clamp_bounds
 
 
 # --- Main execution block ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Neko, the desktop cat.")
+    parser.add_argument("--simulate", type=float, metavar="HOURS",
+                        help="replay HOURS of behaviour headlessly on simulated time and print a report")
+    parser.add_argument("--seed", type=int, default=None, help="RNG seed for --simulate")
+    parser.add_argument("--power-mode", choices=POWER_MODES, default=None,
+                        help="overrides NEKO_POWER_MODE")
+    args = parser.parse_args()
+
+    if args.simulate is not None:
+        report = run_headless_simulation(
+            hours=args.simulate, seed=args.seed,
+            power_mode=args.power_mode or os.getenv("NEKO_POWER_MODE", "adaptive"),
+        )
+        print(json.dumps(report, indent=2))
+        sys.exit(0)
+
     # Optional: make the process DPI aware on Windows so winfo_screenwidth/height return real pixels
     try:
-        import ctypes
         ctypes.windll.user32.SetProcessDPIAware()
     except Exception:
         pass
 
     root = tk.Tk()
-    app = DesktopPetApp(root)
+    app = DesktopPetApp(root, power_mode=args.power_mode)
     root.mainloop()
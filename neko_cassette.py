@@ -0,0 +1,173 @@
+"""
+Record/replay cassettes for chat backends.
+
+A cassette is a JSON-lines file with one model interaction per line: a hash
+of the request, a short excerpt of the user's message, the streamed chunks
+with their offsets from the start of the request, and the error if the
+request failed. generate() calls (history summaries) are recorded too, as
+"kind": "generate" entries holding the whole reply, so a replayed session
+builds the same summaries and its requests keep matching the recording.
+Full prompts are not stored.
+
+    NEKO_CASSETTE_RECORD=session.jsonl python desktop_cat.py   # record real chats
+    NEKO_CHAT_BACKEND=replay://session.jsonl python desktop_cat.py
+    python benchmarks/bench_chat_stream.py --cassette session.jsonl
+"""
+import json
+import time
+import asyncio
+import hashlib
+import collections
+
+from neko_chat import ChatBackend, status_code
+
+
+class CassetteError(RuntimeError):
+    """A recorded failure being replayed (with its status code, if it had one), or a cassette that has run out."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def request_key(contents, memory=()):
+    """Stable hash of a request, used to match replays to recordings."""
+    payload = json.dumps([list(memory), list(contents)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_cassette(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingBackend(ChatBackend):
+    """Passes requests through to `backend` and appends each interaction to the cassette at `path`."""
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.name = f"{backend.name}+record"
+        self.recorded = 0
+
+    async def stream(self, contents, memory=(), timeout=None):
+        entry = {
+            "key": request_key(contents, memory),
+            "prompt": contents[-1]["parts"][-1][:80] if contents else "",
+            "chunks": [],
+            "error": None,
+        }
+        started = time.perf_counter()
+        try:
+            async for text in self.backend.stream(contents, memory, timeout):
+                entry["chunks"].append([round((time.perf_counter() - started) * 1000, 1), text])
+                yield text
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+            entry["code"] = status_code(e)
+            raise
+        except BaseException:
+            entry["error"] = "cancelled"
+            raise
+        finally:
+            entry["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._write(entry)
+
+    async def generate(self, prompt, timeout=None):
+        entry = {"kind": "generate", "key": request_key([prompt]), "prompt": prompt[:80], "reply": None, "error": None}
+        started = time.perf_counter()
+        try:
+            entry["reply"] = await self.backend.generate(prompt, timeout)
+            return entry["reply"]
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+            entry["code"] = status_code(e)
+            raise
+        except BaseException:
+            entry["error"] = "cancelled"
+            raise
+        finally:
+            entry["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._write(entry)
+
+    def stats(self):
+        return self.backend.stats()
+
+    def _write(self, entry):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.recorded += 1
+
+
+class ReplayBackend(ChatBackend):
+    """
+    Serves a cassette back. A request replays the recording of the identical
+    request if there is one left, otherwise the next unused recording of the
+    same kind (stream or generate) in order, so a session replays
+    deterministically even when prompts differ. Chunk timing is reproduced,
+    divided by `speed` (0 means no waiting). With `loop`, the cassette starts
+    over once every recording of that kind is used.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, speed=1.0, loop=True):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.entries = load_cassette(path)
+        self.replayed = 0
+        self.matched = 0
+        # Cassettes recorded before generate() was recorded get a placeholder summary
+        self.has_generate = any(entry.get("kind") == "generate" for entry in self.entries)
+        self._unused = {}
+        self._by_key = {}
+        for kind in ("stream", "generate"):
+            self._reset(kind)
+
+    def _reset(self, kind):
+        self._unused[kind] = collections.OrderedDict(
+            (index, entry) for index, entry in enumerate(self.entries) if entry.get("kind", "stream") == kind
+        )
+        self._by_key[kind] = collections.defaultdict(collections.deque)
+        for index, entry in self._unused[kind].items():
+            self._by_key[kind][entry["key"]].append(index)
+
+    def _take(self, kind, key):
+        unused, by_key = self._unused[kind], self._by_key[kind]
+        if not unused and self.loop:
+            self._reset(kind)
+            unused, by_key = self._unused[kind], self._by_key[kind]
+        if by_key.get(key):
+            index = by_key[key].popleft()
+            self.matched += 1
+        elif unused:
+            index = next(iter(unused))
+            by_key[unused[index]["key"]].remove(index)
+        else:
+            raise CassetteError(f"Cassette {self.path} has no {kind} recordings left")
+        self.replayed += 1
+        return unused.pop(index)
+
+    async def generate(self, prompt, timeout=None):
+        if not self.has_generate:
+            return f"(replayed from {self.path})"
+        entry = self._take("generate", request_key([prompt]))
+        if self.speed:
+            await asyncio.sleep(entry.get("total_ms", 0.0) / 1000.0 / self.speed)
+        if entry["error"]:
+            raise CassetteError(entry["error"], entry.get("code"))
+        return entry["reply"]
+
+    async def stream(self, contents, memory=(), timeout=None):
+        entry = self._take("stream", request_key(contents, memory))
+        elapsed_ms = 0.0
+        for offset_ms, text in entry["chunks"]:
+            if self.speed:
+                await asyncio.sleep(max(0.0, offset_ms - elapsed_ms) / 1000.0 / self.speed)
+            elapsed_ms = offset_ms
+            yield text
+        if entry["error"]:
+            if self.speed:
+                await asyncio.sleep(max(0.0, entry.get("total_ms", elapsed_ms) - elapsed_ms) / 1000.0 / self.speed)
+            raise CassetteError(entry["error"], entry.get("code"))
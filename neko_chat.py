@@ -0,0 +1,1257 @@
+"""
+Chat plumbing for Neko: everything that talks to the model away from the Tk thread.
+"""
+import os
+import re
+import abc
+import json
+import time
+import asyncio
+import heapq
+import random
+import hashlib
+import datetime
+import threading
+import itertools
+import collections
+import concurrent.futures
+
+
+class ChatQueueFull(RuntimeError):
+    """Raised by ChatExecutor.submit() when too many requests are already waiting."""
+
+
+class ChatTimeout(TimeoutError):
+    """A chat request missed its deadline, either while queued or while running."""
+
+
+class ChatRequest:
+    """
+    One queued chat job. `future` is a concurrent.futures.Future, so any thread
+    can wait on it or attach callbacks; cancel() is safe from any thread too.
+    """
+
+    def __init__(self, executor, job, timeout):
+        self.job = job
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.future = concurrent.futures.Future()
+        self.cancelled = False
+        self._executor = executor
+        self._task = None
+
+    def cancel(self):
+        self._executor._cancel(self)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class ChatExecutor:
+    """
+    A single long-lived asyncio loop on its own thread that runs chat jobs one
+    at a time, in order. Running them one by one means each turn is built from
+    a ChatHistory that already holds the previous reply; the loop living for
+    the whole app keeps async clients (gRPC) bound to the same loop between
+    requests.
+
+    Jobs are coroutine functions taking no arguments. The queue is bounded,
+    every request gets a deadline, and requests can be cancelled individually
+    or all at once (chat window closed, app quitting).
+    """
+
+    def __init__(self, max_pending=8, default_timeout=60.0, name="neko-chat"):
+        self.max_pending = max_pending
+        self.default_timeout = default_timeout
+        self._pending = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    @property
+    def pending(self):
+        """Requests queued or running."""
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, job, timeout=None):
+        """Queues `job` (an async callable) and returns its ChatRequest."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Chat executor is shut down")
+            if len(self._pending) >= self.max_pending:
+                raise ChatQueueFull(f"{len(self._pending)} chat requests are already waiting")
+            request = ChatRequest(self, job, timeout or self.default_timeout)
+            self._pending.append(request)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, request)
+        return request
+
+    def call_soon(self, callback, *args):
+        """Runs a plain callback on the chat loop, e.g. to update state only the loop touches."""
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def cancel_all(self):
+        with self._lock:
+            requests = list(self._pending)
+        for request in requests:
+            request.cancel()
+
+    def shutdown(self, timeout=2.0):
+        """Cancels everything and stops the loop thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.cancel_all()
+        self._loop.call_soon_threadsafe(self._worker_task.cancel)
+        self._thread.join(timeout)
+
+    def _cancel(self, request):
+        request.cancelled = True
+        request.future.cancel()
+        self._loop.call_soon_threadsafe(self._cancel_task, request)
+
+    @staticmethod
+    def _cancel_task(request):
+        if request._task is not None:
+            request._task.cancel()
+
+    def _finish(self, request):
+        with self._lock:
+            if request in self._pending:
+                self._pending.remove(request)
+        request._task = None
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._worker_task = self._loop.create_task(self._worker())
+        self._started.set()
+        try:
+            self._loop.run_until_complete(self._worker_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Background tasks such as history folding die with the loop
+            leftovers = asyncio.all_tasks(self._loop)
+            for task in leftovers:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*leftovers, return_exceptions=True))
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+
+    async def _worker(self):
+        while True:
+            request = await self._queue.get()
+            if request.cancelled:
+                self._finish(request)
+                continue
+            remaining = request.deadline - time.monotonic()
+            if remaining <= 0:
+                self._set_exception(request, ChatTimeout("Chat request expired while queued"))
+                self._finish(request)
+                continue
+
+            request._task = asyncio.ensure_future(request.job())
+            try:
+                # Not wait_for: a TimeoutError raised by the job itself (the same class as
+                # asyncio.TimeoutError on 3.11+) must reach the caller unchanged
+                done, _ = await asyncio.wait((request._task,), timeout=remaining)
+                if not done:
+                    request._task.cancel()
+                    raise ChatTimeout(f"No reply within {request.timeout:g} s")
+                result = request._task.result()
+            except asyncio.CancelledError:
+                if self._closed or not request.cancelled:
+                    raise  # The worker itself is being shut down
+            except Exception as e:
+                self._set_exception(request, e)
+            else:
+                self._set_result(request, result)
+            finally:
+                self._finish(request)
+
+    # cancel() may land from the Tk thread between a done() check and the set,
+    # so a future that is already settled is simply left alone
+
+    @staticmethod
+    def _set_result(request, result):
+        try:
+            request.future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    @staticmethod
+    def _set_exception(request, error):
+        try:
+            request.future.set_exception(error)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token); good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+ChatTurn = collections.namedtuple("ChatTurn", "user model tokens")
+
+
+class ChatHistory:
+    """
+    Conversation memory with a fixed token budget. Recent turns are sent
+    verbatim; once they outgrow the budget the oldest ones are folded into a
+    running summary by `summarize(summary, turns)`, a coroutine function that
+    returns the new summary text. Folding runs as its own task on the chat
+    loop, so no reply ever waits for it; until it finishes the prompt simply
+    leaves out whatever no longer fits.
+
+    Only touch a ChatHistory from the chat executor's loop.
+    """
+
+    summary_preamble = "Notes on our conversation so far:\n"
+    summary_ack = "Got it."
+
+    def __init__(self, summarize, max_tokens=4000, summary_tokens=400):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.turns = collections.deque()
+        self.turn_tokens = 0
+        self.folds = 0
+        self._fold_task = None
+
+    def build(self, message):
+        """
+        Contents for the next request: as many recent turns as fit, then
+        `message`. Room for the summary is reserved; send memory() before these.
+        """
+        budget = self.max_tokens - estimate_tokens(message)
+        if self.summary:
+            budget -= estimate_tokens(self.summary_preamble + self.summary + self.summary_ack)
+        recent = []
+        for turn in reversed(self.turns):
+            if turn.tokens > budget:
+                break
+            budget -= turn.tokens
+            recent.append(turn)
+        contents = []
+        for turn in reversed(recent):
+            contents += [
+                {"role": "user", "parts": [turn.user]},
+                {"role": "model", "parts": [turn.model]},
+            ]
+        contents.append({"role": "user", "parts": [message]})
+        return contents
+
+    def memory(self):
+        """The long-lived part of the prompt (the running summary), as contents."""
+        if not self.summary:
+            return []
+        return [
+            {"role": "user", "parts": [self.summary_preamble + self.summary]},
+            {"role": "model", "parts": [self.summary_ack]},
+        ]
+
+    def record(self, user, model):
+        """Adds a completed exchange and starts a fold if the turns outgrew their share."""
+        turn = ChatTurn(user, model, estimate_tokens(user) + estimate_tokens(model))
+        self.turns.append(turn)
+        self.turn_tokens += turn.tokens
+        if self._fold_task is None and self.turn_tokens > self.max_tokens - self.summary_tokens:
+            # Fold down to half the budget so this doesn't run after every turn
+            folded, remaining = [], self.turn_tokens
+            for old in self.turns:
+                if remaining <= self.max_tokens // 2 or len(folded) == len(self.turns) - 1:
+                    break
+                folded.append(old)
+                remaining -= old.tokens
+            if folded:
+                self._fold_task = asyncio.get_running_loop().create_task(self._fold(folded))
+
+    async def _fold(self, turns):
+        try:
+            summary = await self.summarize(self.summary, turns)
+        except Exception as e:
+            print(f"Could not summarise chat history: {e}")
+        else:
+            # Keep the summary inside its share even if the model ignored the length hint
+            self.summary = summary.strip()[:self.summary_tokens * 4]
+            for turn in turns:
+                self.turns.popleft()
+                self.turn_tokens -= turn.tokens
+            self.folds += 1
+        finally:
+            self._fold_task = None
+
+    def fold_prompt(self, summary, turns):
+        """Prompt asking a model to merge `turns` into `summary`."""
+        lines = [
+            f"Update the summary of a chat between a user and their desktop cat Neko. "
+            f"Keep names, facts about the user, promises and open questions; drop small talk. "
+            f"Answer with the new summary only, at most {self.summary_tokens * 3 // 4} words.",
+            "",
+            "Current summary:",
+            summary or "(none)",
+            "",
+            "New messages:",
+        ]
+        for turn in turns:
+            lines += [f"User: {turn.user}", f"Neko: {turn.model}"]
+        return "\n".join(lines)
+
+
+def _contents_key(contents):
+    return tuple((content["role"], tuple(content["parts"])) for content in contents)
+
+
+class ChatBackend(abc.ABC):
+    """
+    What the chat path needs from a model. `contents` are Gemini-style
+    content dicts ({"role": ..., "parts": [...]}); `memory` is long-lived
+    context sent before them (see ChatHistory.memory()).
+
+    Backends implement stream(); complete(), complete_sync() and generate()
+    have defaults built on it. Async methods run on the chat loop;
+    complete_sync() is for scripts and benchmarks with no loop running.
+    `timeout` (seconds) is passed on to the transport where it has one;
+    enforcing it is up to the caller (see ResilientBackend).
+    """
+
+    name = "backend"
+
+    @abc.abstractmethod
+    def stream(self, contents, memory=(), timeout=None):
+        """Async iterator over the reply's text chunks; implement it as an async generator."""
+
+    async def complete(self, contents, memory=(), timeout=None):
+        """The whole reply at once."""
+        return "".join([text async for text in self.stream(contents, memory, timeout)])
+
+    def complete_sync(self, contents, memory=(), timeout=None):
+        return asyncio.run(self.complete(contents, memory, timeout))
+
+    async def generate(self, prompt, timeout=None):
+        """One-off request outside the conversation (summaries and other housekeeping)."""
+        return await self.complete([{"role": "user", "parts": [prompt]}], timeout=timeout)
+
+    def stats(self):
+        """Counters for the debug view: {section: {name: value}}. Wrappers add their inner backend's."""
+        return {}
+
+
+class GeminiBackend(ChatBackend):
+    """
+    Sends Neko's conversation to Gemini. `genai` is the google.generativeai
+    module or anything with the same surface, e.g. neko_mock.OfflineGenAI.
+
+    With `client_factory`, requests go through a client of the backend's own
+    (built lazily on the chat loop, where gRPC's asyncio channel must live).
+
+    With `cache_ttl_s` set, the persona and the long-lived memory go into a
+    CachedContent instead of being re-sent with every message. The cache is
+    created, refreshed before it expires and replaced when the memory changes
+    in background tasks; until one is ready, or if caching is not available
+    (old SDK, context below the API's minimum size, ...), requests carry the
+    whole prompt as before.
+
+    Only use a GeminiBackend from the chat executor's loop.
+    """
+
+    name = "gemini"
+
+    def __init__(self, genai, model_name, system_instruction, cache_ttl_s=None,
+                 refresh_margin_s=120, retry_after_s=600, client_factory=None):
+        self.genai = genai
+        self.model_name = model_name
+        self.name = f"gemini/{model_name}"
+        # Makes this backend's own async client (e.g. for one key of a KeyPoolBackend);
+        # None uses whatever genai.configure() set up
+        self.client_factory = client_factory
+        self._client_bound = client_factory is None
+        self.system_instruction = system_instruction
+        self.cache_ttl_s = cache_ttl_s
+        self.refresh_margin_s = refresh_margin_s
+        self.retry_after_s = retry_after_s
+        self.model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+        self.plain_model = genai.GenerativeModel(model_name=model_name)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = None
+        self._cache_key = None
+        self._cached_model = None
+        self._cache_expires = 0.0
+        self._cache_task = None
+        self._cache_retry_at = 0.0
+
+    async def stream(self, contents, memory=(), timeout=None):
+        """Yields the reply to `memory` + `contents` as text chunks."""
+        self._bind_client()
+        model = self._cached_model_for(memory)
+        if model is None:
+            model, contents = self.model, list(memory) + list(contents)
+        response = await model.generate_content_async(
+            contents, stream=True, request_options=self._request_options(timeout)
+        )
+        async for chunk in response:
+            text = chunk.text
+            if text:
+                yield text
+
+    async def generate(self, prompt, timeout=None):
+        # Without the persona: housekeeping prompts shouldn't be answered in character
+        self._bind_client()
+        response = await self.plain_model.generate_content_async(
+            prompt, request_options=self._request_options(timeout)
+        )
+        return response.text
+
+    def stats(self):
+        if not self.cache_ttl_s:
+            return {}
+        return {self.name: {"context cache hits": self.cache_hits, "context cache misses": self.cache_misses}}
+
+    def _bind_client(self):
+        if self._client_bound:
+            return
+        client = self.client_factory()
+        for model in (self.model, self.plain_model):
+            model._async_client = client
+        self._client_bound = True
+
+    @staticmethod
+    def _request_options(timeout):
+        # The gRPC deadline makes the server give up too, not just our side
+        return {"timeout": timeout} if timeout else None
+
+    def _cached_model_for(self, memory):
+        if not self.cache_ttl_s:
+            return None
+        key = _contents_key(memory)
+        now = time.monotonic()
+        if self._cache_task is None and now >= self._cache_retry_at:
+            if self._cached_model is None or key != self._cache_key:
+                self._cache_task = asyncio.get_running_loop().create_task(self._create_cache(key, list(memory)))
+            elif now >= self._cache_expires - self.refresh_margin_s:
+                self._cache_task = asyncio.get_running_loop().create_task(self._refresh_cache())
+        if self._cached_model is not None and key == self._cache_key and now < self._cache_expires:
+            self.cache_hits += 1
+            return self._cached_model
+        self.cache_misses += 1
+        return None
+
+    async def _create_cache(self, key, memory):
+        try:
+            cache = await asyncio.to_thread(
+                self.genai.caching.CachedContent.create,
+                model=self.model_name,
+                display_name="neko-persona",
+                system_instruction=self.system_instruction,
+                contents=memory or None,
+                ttl=datetime.timedelta(seconds=self.cache_ttl_s),
+            )
+            model = self.genai.GenerativeModel.from_cached_content(cache)
+        except Exception as e:
+            print(f"Context caching unavailable, sending the full prompt instead: {e}")
+            self._cache_retry_at = time.monotonic() + self.retry_after_s
+            return
+        finally:
+            self._cache_task = None
+        old = self._cache
+        self._cache, self._cache_key, self._cached_model = cache, key, model
+        self._cache_expires = time.monotonic() + self.cache_ttl_s
+        if old is not None:
+            # Stale caches would expire on their own, but they are billed until then
+            try:
+                await asyncio.to_thread(old.delete)
+            except Exception as e:
+                print(f"Could not delete old context cache: {e}")
+
+    async def _refresh_cache(self):
+        try:
+            await asyncio.to_thread(self._cache.update, ttl=datetime.timedelta(seconds=self.cache_ttl_s))
+        except Exception as e:
+            print(f"Could not extend context cache, recreating it: {e}")
+            self._cached_model = None
+        else:
+            self._cache_expires = time.monotonic() + self.cache_ttl_s
+        finally:
+            self._cache_task = None
+
+
+def normalize_prompt(text):
+    """Lower-cases and strips punctuation and extra spaces, so "Hi!!" and "hi" match."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+class ReplyCache:
+    """
+    Remembers replies to prompts Neko hears over and over. Keys are the
+    normalised prompt plus a short hash of the conversational context (the
+    previous reply), so a "yes" only matches a "yes" to the same question.
+    Entries expire after `ttl_s` and the least recently used ones are evicted
+    beyond `max_entries`. With a `path`, the cache survives restarts.
+
+    Not thread-safe; the app only uses it on the Tk thread.
+    """
+
+    def __init__(self, path=None, max_entries=256, ttl_s=7 * 24 * 3600, clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (reply, stored at)
+        if path:
+            self.load()
+
+    @staticmethod
+    def key(prompt, context=""):
+        digest = hashlib.sha1(normalize_prompt(context).encode("utf-8")).hexdigest()[:12]
+        return f"{normalize_prompt(prompt)}|{digest}"
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.clock() - entry[1] > self.ttl_s:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, reply):
+        self._entries[key] = (reply, self.clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable reply cache {self.path}: {e}")
+            return
+        now = self.clock()
+        # Saved oldest first, so the LRU order survives the round trip
+        for key, reply, stored_at in entries:
+            if now - stored_at <= self.ttl_s:
+                self._entries[key] = (reply, stored_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        entries = [[key, reply, stored_at] for key, (reply, stored_at) in self._entries.items()]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+# HTTP-style statuses worth another try: timeouts, rate limits and server trouble
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class ChatUnavailable(RuntimeError):
+    """The circuit breaker is open: the model failed repeatedly and isn't being called for now."""
+
+
+def status_code(error):
+    """HTTP status of a backend error (google.api_core exceptions, mock errors), or None."""
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error):
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    return status_code(error) in RETRYABLE_STATUS
+
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker. After `failure_threshold` failures in a row
+    it opens and allow() is False for `reset_after_s`; then one trial request
+    is let through (half-open), whose outcome closes or re-opens it. Only
+    transport-level failures count; an error the model answered with (a bad
+    request, say) still shows the service is up.
+    """
+
+    def __init__(self, failure_threshold=5, reset_after_s=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0  # Times the breaker has tripped
+        self._opened_at = 0.0
+
+    @property
+    def retry_in_s(self):
+        return max(0.0, self._opened_at + self.reset_after_s - self.clock())
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.retry_in_s > 0:
+            return False
+        # Open and cooled down, or a trial that never reported back: try (again)
+        self.state = "half-open"
+        self._opened_at = self.clock()
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self._opened_at = self.clock()
+
+
+class ResilientBackend(ChatBackend):
+    """
+    Wraps a backend with a deadline per request (`deadline_s`) and per
+    attempt (`attempt_timeout_s`), retries with full-jitter exponential
+    backoff for retryable errors, and a CircuitBreaker that fails fast while
+    the model is down.
+
+    For a streamed reply `attempt_timeout_s` bounds the wait for the first
+    chunk and the gap between chunks, so a long reply that keeps coming is
+    only limited by `deadline_s`. It is only retried before its first chunk;
+    once text has reached the user a failure is final.
+
+    With a QuotaScheduler, every attempt is admitted by it before its timer
+    starts: waiting for quota counts against `deadline_s` only, is never
+    taken for a slow model and never trips the breaker.
+    """
+
+    def __init__(self, backend, deadline_s=45.0, attempt_timeout_s=20.0, max_attempts=3,
+                 backoff_s=0.5, backoff_cap_s=8.0, breaker=None, rng=None, scheduler=None):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.name = backend.name
+        self.deadline_s = deadline_s
+        self.attempt_timeout_s = attempt_timeout_s
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.backoff_cap_s = backoff_cap_s
+        self.breaker = breaker or CircuitBreaker()
+        self.rng = rng or random.Random()
+        self.retries = 0
+        self.fast_failures = 0
+
+    async def stream(self, contents, memory=(), timeout=None):
+        deadline = time.monotonic() + min(timeout or self.deadline_s, self.deadline_s)
+        attempt = 0
+        while True:
+            attempt += 1
+            self._start_attempt(deadline)
+            if self.scheduler is not None:
+                await self._admit(self.scheduler.cost(contents, memory), INTERACTIVE, deadline)
+            # The transport gets the whole remaining deadline; stalls are caught per chunk
+            chunks = self.backend.stream(contents, memory, deadline - time.monotonic())
+            started = False
+            try:
+                while True:
+                    try:
+                        wait = min(self.attempt_timeout_s, deadline - time.monotonic())
+                        text = await self._wait(chunks.__anext__(), wait)
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield text
+            except Exception as e:
+                self._record(e)
+                if started or not self._retry_allowed(e, attempt, deadline):
+                    raise
+                delay = self._backoff(attempt, deadline)
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                await chunks.aclose()
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def generate(self, prompt, timeout=None):
+        deadline = time.monotonic() + min(timeout or self.deadline_s, self.deadline_s)
+        attempt = 0
+        while True:
+            attempt += 1
+            self._start_attempt(deadline)
+            if self.scheduler is not None:
+                await self._admit(self.scheduler.cost([{"role": "user", "parts": [prompt]}]), BACKGROUND, deadline)
+            attempt_timeout = min(self.attempt_timeout_s, deadline - time.monotonic())
+            try:
+                result = await self._wait(self.backend.generate(prompt, attempt_timeout), attempt_timeout)
+            except Exception as e:
+                self._record(e)
+                if not self._retry_allowed(e, attempt, deadline):
+                    raise
+            else:
+                self.breaker.record_success()
+                return result
+            self.retries += 1
+            await asyncio.sleep(self._backoff(attempt, deadline))
+
+    def stats(self):
+        stats = dict(self.backend.stats())
+        stats["resilience"] = {
+            "retries": self.retries,
+            "breaker": self.breaker.state,
+            "breaker trips": self.breaker.opened,
+            "failed fast": self.fast_failures,
+        }
+        if self.scheduler is not None:
+            stats["quota"] = self.scheduler.stats()
+        return stats
+
+    def _start_attempt(self, deadline):
+        """Checks the breaker and the deadline before an attempt."""
+        if not self.breaker.allow():
+            self.fast_failures += 1
+            raise ChatUnavailable(f"Chat is unavailable, trying again in {self.breaker.retry_in_s:.0f} s")
+        if deadline - time.monotonic() <= 0:
+            raise ChatTimeout(f"No reply within {self.deadline_s:g} s")
+
+    async def _admit(self, tokens, priority, deadline):
+        try:
+            await asyncio.wait_for(self.scheduler.acquire(tokens, priority), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise ChatTimeout(f"Out of quota for the next {self.deadline_s:g} s") from None
+
+    @staticmethod
+    async def _wait(awaitable, timeout):
+        try:
+            return await asyncio.wait_for(awaitable, max(0.0, timeout))
+        except asyncio.TimeoutError:
+            raise ChatTimeout("The model stopped responding") from None
+
+    def _record(self, error):
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def _retry_allowed(self, error, attempt, deadline):
+        return is_retryable(error) and attempt < self.max_attempts and time.monotonic() < deadline
+
+    def _backoff(self, attempt, deadline):
+        delay = self.rng.uniform(0, min(self.backoff_cap_s, self.backoff_s * 2 ** (attempt - 1)))
+        return min(delay, max(0.0, deadline - time.monotonic()))
+
+
+async def _first_chunk(chunks):
+    """The first chunk of a stream, or None if it ended without one."""
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class HedgedBackend(ChatBackend):
+    """
+    Sends each turn to `primary`; if no first chunk has arrived after the
+    `percentile` of its recent time-to-first-token, sends the same turn to
+    `secondary` as well and streams whichever answers first. The loser is
+    cancelled, so only one reply ever reaches the user or the history.
+    With a QuotaScheduler the secondary request is admitted by it first (the
+    primary is the caller's to admit, see ResilientBackend); the race goes on
+    meanwhile.
+
+    Counters: requests, hedged (secondary was started), secondary_wins.
+    """
+
+    def __init__(self, primary, secondary, percentile=0.95, initial_delay_s=2.0, min_delay_s=0.3, window=50,
+                 scheduler=None):
+        self.primary = primary
+        self.secondary = secondary
+        self.scheduler = scheduler
+        self.name = f"{primary.name}|{secondary.name}"
+        self.percentile = percentile
+        self.initial_delay_s = initial_delay_s
+        self.min_delay_s = min_delay_s
+        self.ttfts = collections.deque(maxlen=window)  # Primary's recent time to first token, seconds
+        self.requests = 0
+        self.hedged = 0
+        self.secondary_wins = 0
+
+    @property
+    def hedge_delay_s(self):
+        if len(self.ttfts) < 10:
+            return self.initial_delay_s
+        return max(self.min_delay_s, percentile(self.ttfts, self.percentile))
+
+    async def stream(self, contents, memory=(), timeout=None):
+        self.requests += 1
+        started = time.monotonic()
+        streams = [self.primary.stream(contents, memory, timeout)]
+        tasks = [asyncio.ensure_future(_first_chunk(streams[0]))]
+        try:
+            await asyncio.wait(tasks, timeout=self.hedge_delay_s)
+            if not tasks[0].done():
+                self.hedged += 1
+                streams.append(self._secondary_stream(contents, memory, timeout))
+                tasks.append(asyncio.ensure_future(_first_chunk(streams[1])))
+            winner = await self._race(tasks)
+            # A cancelled primary still tells us its first token took at least this long
+            self.ttfts.append(time.monotonic() - started)
+            if winner == 1:
+                self.secondary_wins += 1
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            first = tasks[winner].result()
+            if first is None:
+                return
+            yield first
+            async for text in streams[winner]:
+                yield text
+        finally:
+            for task in tasks:
+                task.cancel()
+            for chunks in streams:
+                await chunks.aclose()
+
+    async def _secondary_stream(self, contents, memory, timeout):
+        if self.scheduler is not None:
+            await self.scheduler.acquire(self.scheduler.cost(contents, memory), INTERACTIVE)
+        async for text in self.secondary.stream(contents, memory, timeout):
+            yield text
+
+    async def _race(self, tasks):
+        """Index of the first task to get a first chunk; if every one fails, the primary's error."""
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.index):
+                if task.exception() is None:
+                    return tasks.index(task)
+            if not pending:
+                raise tasks[0].exception()
+
+    async def generate(self, prompt, timeout=None):
+        # Housekeeping isn't latency-sensitive; don't pay for two requests
+        return await self.primary.generate(prompt, timeout)
+
+    def stats(self):
+        stats = dict(self.primary.stats())
+        stats.update(self.secondary.stats())
+        stats["hedging"] = {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "secondary wins": self.secondary_wins,
+            "hedge delay ms": round(self.hedge_delay_s * 1000),
+        }
+        return stats
+
+
+class LatencyStats:
+    """
+    Rolling time-to-first-token, total time and outcome of the last `window`
+    requests to one backend, plus how many are in flight. A request that
+    failed before its first token may carry the time it waited as a lower
+    bound on its TTFT, so stalls show up in the percentiles.
+    """
+
+    def __init__(self, window=100):
+        self.samples = collections.deque(maxlen=window)  # (ttft s or None, total s, ok)
+        self.in_flight = 0
+        self.last_at = 0.0
+
+    def record(self, ttft_s, total_s, ok):
+        self.samples.append((ttft_s, total_s, ok))
+        self.last_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def snapshot(self):
+        samples = list(self.samples)
+        ttfts = [ttft for ttft, total, ok in samples if ttft is not None]
+        return {
+            "requests": len(samples),
+            "in flight": self.in_flight,
+            "error rate": sum(not ok for ttft, total, ok in samples) / len(samples) if samples else 0.0,
+            "ttft p50 ms": _ms(percentile(ttfts, 0.50)),
+            "ttft p95 ms": _ms(percentile(ttfts, 0.95)),
+            "total p95 ms": _ms(percentile([total for ttft, total, ok in samples if ok], 0.95)),
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000)
+
+
+class RoutedBackend(ChatBackend):
+    """
+    Picks a backend per turn from live statistics. Long or complex prompts
+    go to `strong`. Small talk goes to the healthy one of `backends` with
+    the lowest median time to first token, where healthy means an error rate
+    up to `max_error_rate` and a p95 time to first token within `slo_ttft_s`.
+    Backends with fewer than `min_samples` requests (finished or in flight)
+    count as healthy and fastest, so each gets tried; an unhealthy one is
+    probed again once it has had no traffic for `probe_after_s`. `strong` is
+    never a small-talk candidate; only with nothing healthy does small talk
+    fall back to it.
+
+    A stream cancelled before its first token (a caller's timeout, a lost
+    hedge) counts as a failure with that wait as its TTFT once it has run
+    past `slo_ttft_s`, so a model that hangs stops getting traffic; one
+    cancelled sooner says nothing about health and isn't recorded.
+
+    `last_route` holds the most recent decision and its reason.
+    """
+
+    COMPLEX_MARKERS = ("```", "step by step", "explain", "analyze", "analyse", "compare", "write a", "code")
+
+    def __init__(self, backends, strong, slo_ttft_s=1.5, max_error_rate=0.2, complex_tokens=150,
+                 min_samples=5, probe_after_s=60.0, window=100):
+        self.backends = {backend.name: backend for backend in backends}
+        self.strong = strong
+        self.name = "router"
+        self.slo_ttft_s = slo_ttft_s
+        self.max_error_rate = max_error_rate
+        self.complex_tokens = complex_tokens
+        self.min_samples = min_samples
+        self.probe_after_s = probe_after_s
+        self.latency = {name: LatencyStats(window) for name in self.backends}
+        self.latency.setdefault(strong.name, LatencyStats(window))
+        self.routed = collections.Counter()
+        self.last_route = None
+
+    def is_complex(self, message):
+        lowered = message.casefold()
+        return estimate_tokens(message) > self.complex_tokens or any(m in lowered for m in self.COMPLEX_MARKERS)
+
+    def choose(self, message):
+        """Returns (backend, reason)."""
+        if self.is_complex(message):
+            return self.strong, "long or complex prompt"
+        healthy = []
+        now = time.monotonic()
+        for name in self.backends:
+            stats = self.latency[name]
+            if len(stats) + stats.in_flight < self.min_samples:
+                return self.backends[name], "gathering statistics"
+            if not len(stats):
+                continue  # Its first requests are still out
+            snapshot = stats.snapshot()
+            p95 = snapshot["ttft p95 ms"]
+            if snapshot["error rate"] <= self.max_error_rate and p95 is not None and p95 <= self.slo_ttft_s * 1000:
+                healthy.append((snapshot["ttft p50 ms"], name))
+            elif now - stats.last_at >= self.probe_after_s:
+                return self.backends[name], "probing an unhealthy backend"
+        if not healthy:
+            return self.strong, "no backend within the SLO"
+        ttft, name = min(healthy)
+        return self.backends[name], f"fastest healthy (ttft p50 {ttft} ms)"
+
+    async def stream(self, contents, memory=(), timeout=None):
+        message = contents[-1]["parts"][-1] if contents else ""
+        backend, reason = self.choose(message)
+        self.routed[backend.name] += 1
+        self.last_route = {"backend": backend.name, "reason": reason}
+        latency = self.latency[backend.name]
+        started = time.monotonic()
+        ttft = None
+        latency.in_flight += 1
+        try:
+            async for text in backend.stream(contents, memory, timeout):
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                yield text
+        except asyncio.CancelledError:
+            waited = time.monotonic() - started
+            if ttft is None and waited >= self.slo_ttft_s:
+                latency.record(waited, waited, False)
+            raise
+        except Exception:
+            latency.record(ttft, time.monotonic() - started, False)
+            raise
+        else:
+            latency.record(ttft, time.monotonic() - started, True)
+        finally:
+            latency.in_flight -= 1
+
+    async def generate(self, prompt, timeout=None):
+        return await self.strong.generate(prompt, timeout)
+
+    def stats(self):
+        stats = {}
+        for backend in [*self.backends.values(), self.strong]:
+            stats.update(backend.stats())
+        for name, latency in self.latency.items():
+            stats[f"route {name}"] = dict(latency.snapshot(), routed=self.routed[name])
+        stats["routing"] = dict(self.last_route or {"backend": None, "reason": "no turns yet"})
+        return stats
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """`capacity` units, refilled continuously at `capacity` per `period_s`; 0 (or less) means no limit."""
+
+    def __init__(self, capacity, period_s=60.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.unlimited = capacity <= 0
+        self.rate = capacity / period_s
+        self.clock = clock
+        self.level = float(capacity)
+        self._last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available (amounts above capacity only wait for a full bucket)."""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        if self.unlimited:
+            return
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    @property
+    def available(self):
+        """Units available now. Read-only, so stats can look without racing take()."""
+        if self.unlimited:
+            return float("inf")
+        return max(0.0, min(self.capacity, self.level + (self.clock() - self._last) * self.rate))
+
+
+class QuotaScheduler:
+    """
+    Admits model requests within per-minute request and token quotas (a quota
+    of 0 is not enforced). Callers await acquire(tokens, priority), with
+    cost() as the usual charge: the prompt plus `reply_tokens`. Waiters are
+    served strictly by priority (INTERACTIVE before BACKGROUND), then in
+    arrival order, so a backlog of summaries never delays the user's next
+    message.
+
+    Metrics: granted, throttled (requests that had to queue for quota,
+    whether or not they were served in the end) and the queueing delay per
+    priority.
+    """
+
+    def __init__(self, requests_per_min=10, tokens_per_min=250000, reply_tokens=500, clock=time.monotonic,
+                 window=100):
+        self.reply_tokens = reply_tokens
+        self.clock = clock
+        self.requests = TokenBucket(requests_per_min, 60.0, clock)
+        self.tokens = TokenBucket(tokens_per_min, 60.0, clock)
+        self.granted = 0
+        self.throttled = 0
+        self.delays = {INTERACTIVE: collections.deque(maxlen=window), BACKGROUND: collections.deque(maxlen=window)}
+        self._waiters = []  # heap of (priority, seq, tokens, future, enqueued at)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def cost(self, contents, memory=()):
+        """Tokens to charge for a request: its prompt plus `reply_tokens`."""
+        return self.reply_tokens + sum(
+            estimate_tokens(part) for content in list(memory) + list(contents) for part in content["parts"]
+        )
+
+    async def acquire(self, tokens, priority=INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future, self.clock()))
+        self._dispatch()
+        if not future.done():
+            self.throttled += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Gave up while queued (deadline, chat closed); let the next waiter through
+            self._dispatch()
+            raise
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            priority, seq, tokens, future, enqueued = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.granted += 1
+            self.delays[priority].append(self.clock() - enqueued)
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "waiting": sum(not waiter[3].done() for waiter in self._waiters),
+            "interactive delay p95 ms": _ms(percentile(list(self.delays[INTERACTIVE]), 0.95)),
+            "background delay p95 ms": _ms(percentile(list(self.delays[BACKGROUND]), 0.95)),
+        }
+
+
+def keyed_gemini_client(api_key):
+    """An async Gemini client bound to `api_key`, independent of genai.configure()."""
+    from google.generativeai import client as genai_client
+    manager = genai_client._ClientManager()
+    manager.configure(api_key=api_key)
+    return manager.get_default_client("generative_async")
+
+
+class PooledKey:
+    """One API key of a KeyPoolBackend: its backend, request budget and 429 cooldown."""
+
+    def __init__(self, label, backend, requests_per_min, clock=time.monotonic):
+        self.label = label
+        self.backend = backend
+        self.budget = TokenBucket(requests_per_min, 60.0, clock)
+        self.clock = clock
+        self.cooldown_until = 0.0
+        self.cooldown_s = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+
+    @property
+    def cooling_down(self):
+        return self.clock() < self.cooldown_until
+
+    def rate_limit_hit(self, base_s, cap_s):
+        """429: rest the key, twice as long each time it happens again."""
+        self.rate_limited += 1
+        self.cooldown_s = min(cap_s, self.cooldown_s * 2 if self.cooldown_s else base_s)
+        self.cooldown_until = self.clock() + self.cooldown_s
+
+    def succeeded(self):
+        self.cooldown_s = 0.0
+
+
+class KeyPoolError(RuntimeError):
+    """Every key in the pool is cooling down after rate limiting."""
+
+    code = 429
+
+
+class KeyPoolBackend(ChatBackend):
+    """
+    Spreads requests over several API keys, each with its own backend and
+    client. Every key tracks its own per-minute request budget; a request
+    goes to the key with the most budget left and the fewest requests in
+    flight. A key that gets a 429 cools down (`cooldown_s`, doubling up to
+    `cooldown_cap_s`) and is skipped meanwhile.
+    """
+
+    def __init__(self, backends, requests_per_min=10, cooldown_s=30.0, cooldown_cap_s=300.0, clock=time.monotonic):
+        self.keys = [
+            PooledKey(f"key{i + 1}", backend, requests_per_min, clock) for i, backend in enumerate(backends)
+        ]
+        self.name = f"{backends[0].name} x{len(backends)} keys"
+        self.cooldown_s = cooldown_s
+        self.cooldown_cap_s = cooldown_cap_s
+
+    def pick(self):
+        available = [key for key in self.keys if not key.cooling_down]
+        if not available:
+            soonest = min(key.cooldown_until for key in self.keys) - self.keys[0].clock()
+            raise KeyPoolError(f"All API keys are rate limited, the first one is back in {soonest:.0f} s")
+        # Most budget left first, then least loaded, then the key used least
+        return min(available, key=lambda key: (-key.budget.available, key.in_flight, key.requests))
+
+    async def stream(self, contents, memory=(), timeout=None):
+        key = self.pick()
+        key.budget.take(1)
+        key.requests += 1
+        key.in_flight += 1
+        try:
+            async for text in key.backend.stream(contents, memory, timeout):
+                yield text
+        except Exception as e:
+            if status_code(e) == 429:
+                key.rate_limit_hit(self.cooldown_s, self.cooldown_cap_s)
+            raise
+        else:
+            key.succeeded()
+        finally:
+            key.in_flight -= 1
+
+    async def generate(self, prompt, timeout=None):
+        key = self.pick()
+        key.budget.take(1)
+        key.requests += 1
+        key.in_flight += 1
+        try:
+            result = await key.backend.generate(prompt, timeout)
+        except Exception as e:
+            if status_code(e) == 429:
+                key.rate_limit_hit(self.cooldown_s, self.cooldown_cap_s)
+            raise
+        finally:
+            key.in_flight -= 1
+        key.succeeded()
+        return result
+
+    def stats(self):
+        stats = {}
+        for key in self.keys:
+            stats.update(key.backend.stats())
+            stats[f"api {key.label}"] = {
+                "requests": key.requests,
+                "rate limited": key.rate_limited,
+                "in flight": key.in_flight,
+                "budget left": round(key.budget.available, 1),
+                "cooldown s": round(max(0.0, key.cooldown_until - key.clock())),
+            }
+        return stats
@@ -0,0 +1,319 @@
+"""
+Offline stand-ins for the chat model, for UI and throughput tests without an
+API key or network.
+
+MockBackend runs in-process. MockChatServer serves a MockBackend over TCP
+(one JSON object per line) and RemoteBackend talks to it, so the whole
+request path including socket I/O can be exercised from another process:
+
+    python neko_mock.py --port 8765 --latency 0.4 --tokens-per-s 40 --error-rate 0.05
+    NEKO_CHAT_BACKEND=mock://127.0.0.1:8765 python desktop_cat.py
+
+OfflineGenAI stands in one level lower, for the google.generativeai module
+itself, so the real GeminiBackend (context caching included) runs offline:
+
+    NEKO_GEMINI_OFFLINE=1 python desktop_cat.py
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+
+from neko_chat import ChatBackend, estimate_tokens
+
+
+class MockBackendError(RuntimeError):
+    """An error injected by MockBackend (or relayed from a MockChatServer), with an HTTP-style status code."""
+
+    def __init__(self, message, code=503):
+        super().__init__(message)
+        self.code = code
+
+
+MOCK_REPLY_WORDS = (
+    "Meow! *Purrrr* Hmph, fine, I suppose I can help you with that. "
+    "But only because you asked nicely and there might be tuna involved later. "
+    "Now scratch behind my ears while you think about it, human."
+).split(" ")
+
+
+class MockBackend(ChatBackend):
+    """
+    Fake model with controllable timing and failures:
+      latency_s      time to the first chunk (plus up to `jitter_s` extra)
+      tokens_per_s   streaming rate after the first chunk
+      chunk_tokens   words per chunk
+      reply_tokens   words per reply
+      error_rate     chance that a request fails, either before the first
+                     chunk or part-way through the stream
+      error_code     status code of injected failures (503, 429, 400, ...)
+    Counters: requests, failures.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency_s=0.3, jitter_s=0.0, tokens_per_s=50.0, chunk_tokens=4,
+                 reply_tokens=40, error_rate=0.0, error_code=503, seed=None):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.tokens_per_s = tokens_per_s
+        self.chunk_tokens = chunk_tokens
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+
+    def reply_words(self, contents):
+        last = contents[-1]["parts"][-1] if contents else ""
+        words = [f"({last[:40]})"] + list(MOCK_REPLY_WORDS)
+        while len(words) < self.reply_tokens:
+            words += MOCK_REPLY_WORDS
+        return words[:self.reply_tokens]
+
+    async def stream(self, contents, memory=(), timeout=None):
+        self.requests += 1
+        words = self.reply_words(contents)
+        # Decide up front where (if anywhere) this request fails, so a seed replays exactly
+        fail_at = None
+        if self.rng.random() < self.error_rate:
+            fail_at = self.rng.randrange(0, len(words))
+        await asyncio.sleep(self.latency_s + self.rng.uniform(0, self.jitter_s))
+        for i in range(0, len(words), self.chunk_tokens):
+            if fail_at is not None and fail_at < i + self.chunk_tokens:
+                self.failures += 1
+                raise MockBackendError(f"injected failure after {i} tokens", self.error_code)
+            if i:
+                await asyncio.sleep(self.chunk_tokens / self.tokens_per_s)
+            chunk = " ".join(words[i:i + self.chunk_tokens])
+            yield chunk if i + self.chunk_tokens >= len(words) else chunk + " "
+
+
+class MockChatServer:
+    """
+    Serves `backend` over TCP. A client sends one JSON line
+    {"contents": [...], "memory": [...]} and gets back one line per chunk,
+    {"text": ...}, then {"done": true} or {"error": message, "code": status}.
+    """
+
+    def __init__(self, backend, host="127.0.0.1", port=0):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Mock chat server listening on {self.host}:{self.port}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                try:
+                    async for text in self.backend.stream(request["contents"], request.get("memory", ())):
+                        writer.write(json.dumps({"text": text}).encode() + b"\n")
+                        await writer.drain()
+                except MockBackendError as e:
+                    writer.write(json.dumps({"error": str(e), "code": e.code}).encode() + b"\n")
+                else:
+                    writer.write(b'{"done": true}\n')
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            pass  # Client went away, sent garbage, or the server is shutting down
+        finally:
+            writer.close()
+
+
+class RemoteBackend(ChatBackend):
+    """Client for a MockChatServer; one connection per request."""
+
+    name = "mock-remote"
+
+    def __init__(self, host="127.0.0.1", port=8765):
+        self.host = host
+        self.port = port
+
+    @classmethod
+    def from_url(cls, url):
+        """Parses mock://host:port."""
+        host, _, port = url.split("://", 1)[-1].rpartition(":")
+        return cls(host or "127.0.0.1", int(port))
+
+    async def stream(self, contents, memory=(), timeout=None):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            request = {"contents": list(contents), "memory": list(memory)}
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "text" in message:
+                    yield message["text"]
+                elif "error" in message:
+                    raise MockBackendError(message["error"], message.get("code", 503))
+                else:
+                    return
+            raise ConnectionError("Mock chat server closed the connection mid-reply")
+        finally:
+            writer.close()
+
+
+class _OfflineChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _OfflineResponse:
+    def __init__(self, text, chunk_words, chunk_delay_s):
+        self.text = text
+        self._chunk_words = chunk_words
+        self._chunk_delay_s = chunk_delay_s
+
+    async def __aiter__(self):
+        words = self.text.split(" ")
+        for i in range(0, len(words), self._chunk_words):
+            await asyncio.sleep(self._chunk_delay_s)
+            chunk = " ".join(words[i:i + self._chunk_words])
+            yield _OfflineChunk(chunk if i + self._chunk_words >= len(words) else chunk + " ")
+
+
+class _OfflineModel:
+    def __init__(self, genai, model_name, system_instruction=None, cached_content=None):
+        self.genai = genai
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached_content = cached_content
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        if isinstance(contents, str):
+            contents = [{"role": "user", "parts": [contents]}]
+        if self.cached_content is not None and self.cached_content.expired():
+            raise RuntimeError(f"{self.cached_content.name} has expired")
+        self.genai.requests.append({
+            "model": self.model_name,
+            "cached_content": self.cached_content.name if self.cached_content else None,
+            "contents": len(contents),
+            "tokens": sum(estimate_tokens(part) for content in contents for part in content["parts"]),
+        })
+        last = contents[-1]["parts"][-1]
+        text = f"Meow! *Purrrr* You said: {last[:200]}"
+        if not stream:
+            await asyncio.sleep(self.genai.chunk_delay_s)
+        return _OfflineResponse(text, self.genai.chunk_words, self.genai.chunk_delay_s)
+
+
+class _OfflineModels:
+    """What `genai.GenerativeModel` is on an OfflineGenAI: callable, plus from_cached_content()."""
+
+    def __init__(self, genai):
+        self.genai = genai
+
+    def __call__(self, model_name, system_instruction=None, **kwargs):
+        return _OfflineModel(self.genai, model_name, system_instruction)
+
+    def from_cached_content(self, cached_content):
+        return _OfflineModel(self.genai, cached_content.model, cached_content.system_instruction, cached_content)
+
+
+class _OfflineCachedContent:
+    def __init__(self, genai, name, model, system_instruction, ttl):
+        self.genai = genai
+        self.name = name
+        self.model = model
+        self.system_instruction = system_instruction
+        self.expire_time = time.monotonic() + ttl.total_seconds()
+
+    def expired(self):
+        return time.monotonic() >= self.expire_time
+
+    def update(self, ttl=None, **kwargs):
+        self.expire_time = time.monotonic() + ttl.total_seconds()
+
+    def delete(self):
+        self.genai.caches.pop(self.name, None)
+
+
+class _OfflineCaching:
+    """What `genai.caching.CachedContent` is on an OfflineGenAI."""
+
+    def __init__(self, genai):
+        self.genai = genai
+        self.CachedContent = self
+
+    def create(self, model, display_name=None, system_instruction=None, contents=None, ttl=None, **kwargs):
+        tokens = estimate_tokens(system_instruction or "") + sum(
+            estimate_tokens(part) for content in contents or () for part in content["parts"]
+        )
+        if tokens < self.genai.min_cache_tokens:
+            raise ValueError(f"Cached content is too small: {tokens} < {self.genai.min_cache_tokens} tokens")
+        name = f"cachedContents/offline-{next(self.genai._cache_ids)}"
+        cache = _OfflineCachedContent(self.genai, name, model, system_instruction, ttl)
+        self.genai.caches[name] = cache
+        return cache
+
+
+class OfflineGenAI:
+    """
+    Local stand-in for the google.generativeai module: the pieces GeminiBackend
+    uses (GenerativeModel, from_cached_content, caching.CachedContent), with
+    canned cat replies streamed a few words at a time and no network access.
+    Every request is logged in `requests`; live caches are in `caches`.
+    """
+
+    def __init__(self, chunk_words=3, chunk_delay_s=0.05, min_cache_tokens=0):
+        self.chunk_words = chunk_words
+        self.chunk_delay_s = chunk_delay_s
+        self.min_cache_tokens = min_cache_tokens
+        self.requests = []
+        self.caches = {}
+        self._cache_ids = itertools.count(1)
+        self.GenerativeModel = _OfflineModels(self)
+        self.caching = _OfflineCaching(self)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock Neko chat model over TCP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds to the first chunk")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds of latency")
+    parser.add_argument("--tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--chunk-tokens", type=int, default=4)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-code", type=int, default=503, help="status code of injected failures")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    backend = MockBackend(
+        latency_s=args.latency,
+        jitter_s=args.jitter,
+        tokens_per_s=args.tokens_per_s,
+        chunk_tokens=args.chunk_tokens,
+        reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        seed=args.seed,
+    )
+    try:
+        asyncio.run(MockChatServer(backend, args.host, args.port).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Checks for the animation side of desktop_cat: GIF splitting, the frame
+scheduler and the pet engine. Nothing here opens a window; timers are
+driven by hand or by a VirtualClock.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from desktop_cat import (  # noqa: E402
+    DEFAULT_FRAME_MS, FrameScheduler, HeadlessRenderer, PetEngine, VirtualClock, build_clip_timeline,
+    compile_animation_states, load_animation_manifest, resource_path, run_headless_simulation, split_gif_frames,
+)
+
+IMAGE_DIR = resource_path("image")
+
+
+def tiny_gif(delays_ms):
+    """A 1x1 animated GIF with one frame per delay (in ms, stored in 1/100 s)."""
+    data = b"GIF89a" + b"\x01\x00\x01\x00" + b"\x80\x00\x00" + b"\x00\x00\x00\xff\xff\xff"
+    for delay in delays_ms:
+        data += b"\x21\xf9\x04\x00" + (delay // 10).to_bytes(2, "little") + b"\x00\x00"
+        data += b"\x2c\x00\x00\x00\x00\x01\x00\x01\x00\x00" + b"\x02\x02\x44\x01\x00"
+    return data + b"\x3b"
+
+
+class ManualTimer:
+    """A timer whose callbacks only run when the test fires them, at a time it picks."""
+
+    def __init__(self):
+        self.time = 0.0
+        self.pending = []
+
+    def now(self):
+        return self.time
+
+    def after(self, delay_ms, callback):
+        self.pending.append((delay_ms, callback))
+        return len(self.pending)
+
+    def after_cancel(self, timer_id):
+        pass
+
+    def fire_at(self, time):
+        self.time = time
+        delay_ms, callback = self.pending.pop(0)
+        callback()
+
+
+class ScriptedRng:
+    """Picks the next states from a script of state indexes instead of at random."""
+
+    def __init__(self, picks):
+        self.picks = list(picks)
+
+    def choice(self, options):
+        pick = self.picks.pop(0)
+        assert pick in options
+        return pick
+
+
+# --- GIF splitting ---
+
+def test_each_frame_becomes_a_standalone_gif():
+    frames = split_gif_frames(tiny_gif([100, 200, 300]))
+    assert len(frames) == 3
+    for frame in frames:
+        assert frame.data.startswith(b"GIF89a") and frame.data.endswith(b"\x3b")
+        # Splitting a split frame gives back just that frame
+        assert [again.data for again in split_gif_frames(frame.data)] == [frame.data]
+
+
+@pytest.mark.parametrize("name, count", [
+    ("idle.gif", 5), ("sleep.gif", 3), ("walking_positive.gif", 8), ("idle_to_sleep.gif", 8),
+])
+def test_bundled_gifs_split_into_their_frames(name, count):
+    with open(os.path.join(IMAGE_DIR, name), "rb") as file:
+        assert len(split_gif_frames(file.read())) == count
+
+
+def test_not_a_gif_is_rejected():
+    with pytest.raises(ValueError):
+        split_gif_frames(b"\x89PNG\r\n\x1a\n" + bytes(16))
+
+
+def test_a_corrupt_block_is_rejected():
+    with pytest.raises(ValueError, match="Corrupt GIF"):
+        split_gif_frames(tiny_gif([100])[:-1] + b"\x99")
+
+
+def test_frame_delays_come_from_the_graphic_control_extension():
+    assert [frame.delay for frame in split_gif_frames(tiny_gif([100, 250, 0]))] == [100, 250, DEFAULT_FRAME_MS]
+
+
+# --- Animation manifest ---
+
+def test_frame_ms_overrides_the_gif_delays():
+    clips = {"walk": build_clip_timeline("walk", ["a", "b"], [140, 140])}
+    states = {
+        "as_drawn": {"clip": "walk", "next": {"pinned": 1}},
+        "pinned": {"clip": "walk", "frame_ms": 100, "next": {"as_drawn": 1}},
+    }
+    compiled, index = compile_animation_states(states, clips)
+    assert compiled[index["as_drawn"]].delays == (140, 140)
+    assert compiled[index["pinned"]].delays == (100, 100)
+    assert compiled[index["pinned"]].duration == 200
+
+
+def test_low_power_cadence_only_applies_outside_full_mode():
+    clips = {"sleep": build_clip_timeline("sleep", ["a"], [500])}
+    states = {"sleep": {"clip": "sleep", "low_power_frame_ms": 1000, "next": {"sleep": 1}}}
+    assert compile_animation_states(states, clips, "full")[0][0].delays == (500,)
+    assert compile_animation_states(states, clips, "adaptive")[0][0].delays == (1000,)
+    with pytest.raises(ValueError):
+        compile_animation_states(states, clips, "turbo")
+
+
+def test_bundled_walk_and_transitions_keep_a_100_ms_cadence():
+    states = load_animation_manifest(os.path.join(IMAGE_DIR, "manifest.json"))["states"]
+    for name in ("walk_left", "walk_right", "idle_to_sleep", "sleep_to_idle"):
+        assert states[name]["frame_ms"] == 100
+
+
+# --- FrameScheduler ---
+
+def started_scheduler(interval_ms=100, max_lag=3):
+    timer = ManualTimer()
+    frames = []
+    scheduler = FrameScheduler(timer, frames.append, interval_ms=interval_ms, max_lag=max_lag)
+    scheduler.start()
+    return timer, scheduler, frames
+
+
+def test_on_time_ticks_wait_one_interval():
+    timer, scheduler, frames = started_scheduler()
+    timer.fire_at(0.0)
+    timer.fire_at(0.1)
+    assert frames == [1, 1]
+    assert timer.pending[0][0] == 100
+
+
+def test_lateness_does_not_accumulate():
+    timer, scheduler, frames = started_scheduler()
+    timer.fire_at(0.0)
+    timer.fire_at(0.13)  # 30 ms late
+    # The next frame is due at 0.2, not 0.13 + 0.1
+    assert timer.pending[0][0] == 70
+    assert scheduler.last_lateness_ms == pytest.approx(30)
+
+
+def test_a_short_stall_is_caught_up_frame_by_frame():
+    timer, scheduler, frames = started_scheduler()
+    timer.fire_at(0.25)  # Two and a half frames behind, within max_lag
+    assert timer.pending[0][0] == 0
+    timer.fire_at(0.25)
+    timer.fire_at(0.25)
+    assert frames == [1, 1, 1]
+    assert scheduler.frames_skipped == 0
+    assert timer.pending[0][0] == 50  # Back on the 0.3 s deadline
+
+
+def test_a_long_stall_skips_ahead_and_reports_the_frames():
+    timer, scheduler, frames = started_scheduler()
+    timer.fire_at(1.05)  # Ten and a half frames behind
+    assert frames == [11]
+    assert scheduler.frames_skipped == 10
+    assert timer.pending[0][0] == 50  # The next deadline is still on the 100 ms grid
+
+
+def test_the_callback_can_change_the_interval_and_stop():
+    timer = ManualTimer()
+
+    def tick(frames):
+        scheduler.interval_ms = 500
+        if scheduler.ticks == 2:
+            scheduler.stop()
+
+    scheduler = FrameScheduler(timer, tick, interval_ms=100)
+    scheduler.start()
+    timer.fire_at(0.0)
+    assert timer.pending[0][0] == 500
+    timer.fire_at(0.5)
+    assert not scheduler.running
+    assert timer.pending == []
+
+
+# --- PetEngine suspension ---
+
+IDLE, SLEEP = 0, 1
+
+
+def sleepy_engine(picks):
+    """Idle (2 x 100 ms) always falls asleep; sleep (2 x 500 ms) may suspend the timers."""
+    clips = {
+        "idle": build_clip_timeline("idle", ["idle 0", "idle 1"], [100, 100]),
+        "sleep": build_clip_timeline("sleep", ["sleep 0", "sleep 1"], [500, 500]),
+    }
+    states = {
+        "idle": {"clip": "idle", "next": {"sleep": 1}},
+        "sleep": {"clip": "sleep", "suspend": True, "next": {"sleep": 1, "idle": 1}},
+    }
+    states, index = compile_animation_states(states, clips, "suspend")
+    clock = VirtualClock()
+    engine = PetEngine(states, index, "idle", clock, HeadlessRenderer(), lambda: (100, 100), rng=ScriptedRng(picks))
+    engine.start()
+    return clock, engine
+
+
+def test_a_looping_sleep_stops_the_timer_until_it_would_have_moved_on():
+    # idle -> sleep, sleep loops once (suspend), then two more loops are sampled before idle
+    clock, engine = sleepy_engine([SLEEP, SLEEP, SLEEP, SLEEP, IDLE])
+    clock.run_until(0.7)  # idle 0, idle 1, sleep 0, sleep 1
+    assert engine.suspended and not engine.scheduler.running
+    assert engine.scheduler.ticks == 4
+
+    # Sleep 1 stays up 500 ms, then three loops of 1 s each
+    clock.run_until(4.19)
+    assert engine.suspended and engine.scheduler.ticks == 4
+    clock.run_until(4.2)
+    assert not engine.suspended and engine.state.name == "idle"
+    assert engine.scheduler.ticks == 5
+    assert engine.renderer._image == "idle 0"
+
+
+def test_dwell_times_add_up_to_the_time_that_passed():
+    clock, engine = sleepy_engine([SLEEP, SLEEP, SLEEP, SLEEP, IDLE])
+    clock.run_until(4.2)
+    engine.stop()
+    assert engine.dwell_times() == {"idle": 300, "sleep": 4000}
+    assert sum(engine.dwell_times().values()) == pytest.approx(4300)
+
+
+def test_input_while_suspended_resumes_the_sleep_and_refunds_the_rest():
+    clock, engine = sleepy_engine([SLEEP, SLEEP, SLEEP, SLEEP, IDLE])
+    clock.run_until(1.0)
+    engine.resume()
+    assert not engine.suspended and engine.scheduler.running
+    assert engine.state.name == "sleep"
+    # Shown from 0.2 s to now; the 3.2 s still ahead was never slept
+    assert engine.dwell_times()["sleep"] == pytest.approx(800)
+    assert engine.renderer._image == "sleep 1"
+    clock.run_until(1.0)
+    assert engine.renderer._image == "sleep 0"
+
+
+def test_stopping_mid_sleep_only_charges_the_time_slept():
+    clock, engine = sleepy_engine([SLEEP, SLEEP, SLEEP, SLEEP, IDLE])
+    clock.run_until(2.0)
+    engine.stop()
+    assert not engine.suspended
+    assert sum(engine.dwell_times().values()) == pytest.approx(2000)
+    clock.run_until(10.0)
+    assert engine.scheduler.ticks == 4
+
+
+# --- VirtualClock and the headless simulator ---
+
+def test_virtual_clock_runs_callbacks_in_deadline_order():
+    clock = VirtualClock()
+    seen = []
+    clock.after(300, lambda: seen.append(("c", clock.now())))
+    clock.after(100, lambda: seen.append(("a", clock.now())))
+    clock.after(200, lambda: clock.after(50, lambda: seen.append(("b", clock.now()))))
+    cancelled = clock.after(150, lambda: seen.append(("cancelled", clock.now())))
+    clock.after_cancel(cancelled)
+    clock.run_until(1.0)
+    assert seen == [("a", 0.1), ("b", 0.25), ("c", 0.3)]
+    assert clock.now() == 1.0
+    assert clock.callbacks_run == 4
+
+
+def test_simulated_hour_is_reproducible_for_a_seed():
+    assert run_headless_simulation(hours=1, seed=7)["dwell_s"] == run_headless_simulation(hours=1, seed=7)["dwell_s"]
+
+
+@pytest.mark.parametrize("power_mode", ["full", "adaptive", "suspend"])
+def test_simulated_dwell_covers_the_simulated_time(power_mode):
+    report = run_headless_simulation(hours=1, seed=3, power_mode=power_mode)
+    # At most the frame on screen at the end runs past the hour
+    assert 3600 - 1e-6 <= sum(report["dwell_s"].values()) <= 3601
+
+
+def test_suspending_while_asleep_cuts_timer_wakeups():
+    full = run_headless_simulation(hours=1, seed=3, power_mode="full")
+    suspend = run_headless_simulation(hours=1, seed=3, power_mode="suspend")
+    assert suspend["timer_wakeups"] < full["timer_wakeups"]
+    assert suspend["render_calls_issued"] < full["render_calls_issued"]
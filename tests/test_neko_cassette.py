@@ -0,0 +1,82 @@
+"""
+Checks for neko_cassette: recording a session and replaying it offline.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from neko_chat import ChatHistory  # noqa: E402
+from neko_cassette import CassetteError, RecordingBackend, ReplayBackend, request_key  # noqa: E402
+from neko_mock import MockBackend, MockBackendError  # noqa: E402
+
+
+def chat_session(backend, messages):
+    """Talks through `backend` the way the app does, folding history into summaries; returns the replies."""
+    history = ChatHistory(
+        lambda summary, turns: backend.generate(history.fold_prompt(summary, turns)),
+        max_tokens=120, summary_tokens=30,
+    )
+
+    async def run():
+        replies = []
+        for message in messages:
+            reply = await backend.complete(history.build(message), history.memory())
+            history.record(message, reply)
+            replies.append(reply)
+            await asyncio.sleep(0.01)  # Let a fold finish before the next turn
+        return replies, history.summary, history.folds
+
+    return asyncio.run(run())
+
+
+def test_replay_matches_every_request_of_a_recorded_session(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    messages = [f"message {i}: do you want tuna?" for i in range(12)]
+    mock = MockBackend(latency_s=0, tokens_per_s=10000, reply_tokens=12)
+    recorded = chat_session(RecordingBackend(mock, path), messages)
+    assert recorded[2] > 0  # History was folded, so summaries were recorded too
+
+    replay = ReplayBackend(path, speed=0)
+    assert chat_session(replay, messages) == recorded
+    assert replay.matched == replay.replayed == len(messages) + recorded[2]
+
+
+def test_replay_falls_back_to_recording_order_for_unknown_requests(tmp_path):
+    path = tmp_path / "session.jsonl"
+    entries = [
+        {"key": "a", "prompt": "", "chunks": [[0, "first"]], "error": None},
+        {"key": "b", "prompt": "", "chunks": [[0, "second"]], "error": None},
+    ]
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    replay = ReplayBackend(str(path), speed=0, loop=False)
+    hello = [{"role": "user", "parts": ["hello"]}]
+    assert replay.complete_sync(hello) == "first"
+    assert replay.complete_sync(hello) == "second"
+    with pytest.raises(CassetteError):
+        replay.complete_sync(hello)
+    assert replay.matched == 0
+
+
+def test_recorded_failures_replay_with_their_status_code(tmp_path):
+    path = str(tmp_path / "session.jsonl")
+    mock = MockBackend(latency_s=0, reply_tokens=4, chunk_tokens=4, error_rate=1.0, error_code=429)
+    hello = [{"role": "user", "parts": ["hello"]}]
+    with pytest.raises(MockBackendError):
+        RecordingBackend(mock, path).complete_sync(hello)
+    with pytest.raises(CassetteError) as error:
+        ReplayBackend(path, speed=0).complete_sync(hello)
+    assert error.value.code == 429
+
+
+def test_old_cassettes_without_generate_recordings_still_summarize(tmp_path):
+    path = tmp_path / "session.jsonl"
+    path.write_text(json.dumps({"key": request_key([]), "prompt": "", "chunks": [], "error": None}) + "\n")
+    replay = ReplayBackend(str(path), speed=0)
+    assert asyncio.run(replay.generate("summarize")).startswith("(replayed from")
@@ -0,0 +1,537 @@
+"""
+Checks for neko_chat. Everything runs against MockBackend and injected
+clocks, so no network or API key is needed.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import time
+import types
+import asyncio
+import concurrent.futures
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from neko_chat import (  # noqa: E402
+    BACKGROUND, INTERACTIVE, ChatExecutor, ChatHistory, ChatTimeout, ChatTurn, ChatUnavailable, CircuitBreaker,
+    HedgedBackend, KeyPoolBackend, KeyPoolError, QuotaScheduler, ReplyCache, ResilientBackend, RoutedBackend,
+    TokenBucket, estimate_tokens, status_code,
+)
+from neko_mock import MockBackend, MockBackendError  # noqa: E402
+
+HI = [{"role": "user", "parts": ["hi"]}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def failing(code, **kwargs):
+    # One chunk per reply, so an injected failure always comes before any text
+    return MockBackend(latency_s=0, reply_tokens=4, chunk_tokens=4, error_rate=1.0, error_code=code, **kwargs)
+
+
+# --- ChatExecutor ---
+
+@pytest.fixture
+def executor():
+    executor = ChatExecutor(default_timeout=0.3)
+    yield executor
+    executor.shutdown()
+
+
+def test_executor_runs_jobs_in_order(executor):
+    done = []
+
+    async def job(n):
+        await asyncio.sleep(0.01 * (3 - n))
+        done.append(n)
+        return n
+
+    requests = [executor.submit(lambda n=n: job(n)) for n in range(3)]
+    assert [request.result(2) for request in requests] == [0, 1, 2]
+    assert done == [0, 1, 2]
+
+
+def test_executor_reports_its_own_timeout(executor):
+    async def slow():
+        await asyncio.sleep(5)
+
+    with pytest.raises(ChatTimeout, match="No reply within 0.3 s"):
+        executor.submit(slow).result(2)
+
+
+def test_executor_passes_a_jobs_own_timeout_through(executor):
+    async def stalled():
+        raise TimeoutError("The model stopped responding")
+
+    with pytest.raises(TimeoutError, match="The model stopped responding"):
+        executor.submit(stalled).result(2)
+
+
+def test_executor_keeps_working_after_a_cancelled_request(executor):
+    async def slow():
+        await asyncio.sleep(5)
+
+    async def quick():
+        return "meow"
+
+    request = executor.submit(slow)
+    time.sleep(0.05)
+    request.cancel()
+    assert executor.submit(quick).result(2) == "meow"
+
+
+def test_settling_a_request_cancelled_meanwhile_is_harmless():
+    # cancel() from the Tk thread can land between the worker's done() check and its set
+    request = types.SimpleNamespace(future=concurrent.futures.Future())
+    request.future.cancel()
+    ChatExecutor._set_result(request, "late")
+    ChatExecutor._set_exception(request, RuntimeError("late"))
+    assert request.future.cancelled()
+
+
+# --- ChatHistory ---
+
+def test_history_folds_old_turns_into_the_summary_and_stays_in_budget():
+    folded = []
+
+    async def summarize(summary, turns):
+        folded.append(list(turns))
+        return f"{summary} +{len(turns)}".strip()
+
+    history = ChatHistory(summarize, max_tokens=200, summary_tokens=40)
+
+    async def run():
+        for i in range(20):
+            contents = history.build(f"message {i} " + "x" * 80)
+            assert sum(estimate_tokens(part) for c in history.memory() + contents for part in c["parts"]) <= 200
+            history.record(f"message {i} " + "x" * 80, "meow " * 20)
+            await asyncio.sleep(0)  # Let a fold run
+
+    asyncio.run(run())
+    assert history.folds == len(folded) > 0
+    assert history.summary.startswith("+")
+    assert history.memory()[0]["parts"][0].startswith(history.summary_preamble)
+    assert history.turn_tokens == sum(turn.tokens for turn in history.turns) <= 200
+
+
+def test_history_keeps_turns_when_summarizing_fails():
+    async def summarize(summary, turns):
+        raise RuntimeError("model down")
+
+    history = ChatHistory(summarize, max_tokens=100, summary_tokens=20)
+
+    async def run():
+        for i in range(5):
+            history.record("x" * 80, "y" * 80)
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert history.folds == 0 and len(history.turns) == 5
+    # The prompt still fits: turns that don't are left out
+    contents = history.build("hi")
+    assert sum(estimate_tokens(part) for c in contents for part in c["parts"]) <= 100
+    assert contents[-1] == {"role": "user", "parts": ["hi"]}
+
+
+def test_fold_prompt_lists_the_summary_and_turns():
+    history = ChatHistory(None)
+    prompt = history.fold_prompt("", [ChatTurn("hi", "meow", 2)])
+    assert "(none)" in prompt and "User: hi" in prompt and "Neko: meow" in prompt
+
+
+# --- ReplyCache ---
+
+def test_reply_cache_keys_ignore_case_and_punctuation_but_not_context():
+    assert ReplyCache.key("Hi!!", "Want tuna?") == ReplyCache.key("  hi ", "want tuna")
+    assert ReplyCache.key("yes", "Want tuna?") != ReplyCache.key("yes", "Want a bath?")
+
+
+def test_reply_cache_expires_entries():
+    clock = FakeClock()
+    cache = ReplyCache(ttl_s=10, clock=clock)
+    cache.put("hi|", "Meow!")
+    clock.now += 10
+    assert cache.get("hi|") == "Meow!"
+    clock.now += 1
+    assert cache.get("hi|") is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_reply_cache_evicts_the_least_recently_used():
+    cache = ReplyCache(max_entries=2, clock=FakeClock())
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+
+
+def test_reply_cache_survives_a_restart_in_lru_order(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "cache" / "replies.json")
+    cache = ReplyCache(path, max_entries=2, ttl_s=100, clock=clock)
+    cache.put("old", "1")
+    clock.now += 50
+    cache.put("a", "2")
+    cache.put("b", "3")  # Evicts "old"
+    cache.get("a")  # "b" is now the least recently used
+    cache.save()
+
+    clock.now += 60  # "a" and "b" are both 60 s old
+    restored = ReplyCache(path, max_entries=2, ttl_s=100, clock=clock)
+    assert len(restored) == 2 and restored.get("old") is None
+    restored.put("c", "4")
+    assert restored.get("b") is None and restored.get("a") == "2"
+
+    clock.now += 41
+    assert len(ReplyCache(path, ttl_s=100, clock=clock)) == 0
+
+
+def test_reply_cache_ignores_an_unreadable_file(tmp_path):
+    path = tmp_path / "replies.json"
+    path.write_text("not json")
+    assert len(ReplyCache(str(path))) == 0
+
+
+# --- CircuitBreaker ---
+
+def test_breaker_opens_after_threshold_and_half_opens_after_reset():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_after_s=10.0, clock=clock)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 1
+    assert not breaker.allow()
+
+    clock.now += 10.0
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 2
+
+    clock.now += 10.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_breaker_retries_a_trial_that_never_reported_back():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_after_s=5.0, clock=clock)
+    breaker.record_failure()
+    clock.now += 5.0
+    assert breaker.allow()
+    assert not breaker.allow()  # Trial in flight
+    clock.now += 5.0
+    assert breaker.allow()
+
+
+# --- ResilientBackend ---
+
+def test_retryable_errors_are_retried_up_to_max_attempts():
+    mock = failing(503)
+    backend = ResilientBackend(mock, max_attempts=3, backoff_s=0)
+    with pytest.raises(MockBackendError):
+        asyncio.run(backend.complete(HI))
+    assert mock.requests == 3
+    assert backend.retries == 2
+
+
+def test_non_retryable_errors_fail_at_once_and_do_not_trip_the_breaker():
+    mock = failing(400)
+    breaker = CircuitBreaker(failure_threshold=1)
+    backend = ResilientBackend(mock, max_attempts=3, backoff_s=0, breaker=breaker)
+    with pytest.raises(MockBackendError):
+        asyncio.run(backend.complete(HI))
+    assert mock.requests == 1
+    assert breaker.state == "closed"
+
+
+def test_open_breaker_fails_fast_without_calling_the_model():
+    mock = failing(503)
+    breaker = CircuitBreaker(failure_threshold=2, reset_after_s=60.0)
+    backend = ResilientBackend(mock, max_attempts=2, backoff_s=0, breaker=breaker)
+    with pytest.raises(MockBackendError):
+        asyncio.run(backend.complete(HI))
+    assert breaker.state == "open"
+    with pytest.raises(ChatUnavailable):
+        asyncio.run(backend.complete(HI))
+    assert mock.requests == 2
+    assert backend.fast_failures == 1
+
+
+def test_attempt_timeout_bounds_gaps_between_chunks_not_the_whole_reply():
+    # 20 chunks, 0.05 s apart: one second in all, well past the attempt timeout
+    mock = MockBackend(latency_s=0.01, tokens_per_s=80, chunk_tokens=4, reply_tokens=80)
+    backend = ResilientBackend(mock, deadline_s=5.0, attempt_timeout_s=0.3)
+    reply = asyncio.run(backend.complete(HI))
+    assert len(reply.split()) == 80
+
+
+def test_slow_first_chunk_times_out_and_is_retried():
+    mock = MockBackend(latency_s=1.0)
+    backend = ResilientBackend(mock, deadline_s=5.0, attempt_timeout_s=0.1, max_attempts=2, backoff_s=0)
+    with pytest.raises(ChatTimeout):
+        asyncio.run(backend.complete(HI))
+    assert mock.requests == 2
+
+
+# --- HedgedBackend ---
+
+def named(name, latency_s):
+    backend = MockBackend(latency_s=latency_s, tokens_per_s=10000, reply_tokens=8)
+    backend.name = name
+    return backend
+
+
+def test_slow_primary_is_hedged_and_the_faster_reply_wins():
+    slow, fast = named("slow", 1.0), named("fast", 0.0)
+    backend = HedgedBackend(slow, fast, initial_delay_s=0.05)
+    reply = asyncio.run(backend.complete(HI))
+    assert len(reply.split()) == 8
+    assert (backend.requests, backend.hedged, backend.secondary_wins) == (1, 1, 1)
+    assert slow.requests == fast.requests == 1
+
+
+def test_fast_primary_is_not_hedged():
+    primary, secondary = named("primary", 0.0), named("secondary", 0.0)
+    backend = HedgedBackend(primary, secondary, initial_delay_s=0.5)
+    asyncio.run(backend.complete(HI))
+    assert backend.hedged == 0 and secondary.requests == 0
+
+
+def test_hedge_delay_follows_the_primarys_ttft_percentile():
+    backend = HedgedBackend(named("a", 0), named("b", 0), percentile=0.9, initial_delay_s=2.0, min_delay_s=0.1)
+    backend.ttfts.extend([0.5] * 9)
+    assert backend.hedge_delay_s == 2.0  # Too few samples yet
+    backend.ttfts.append(3.0)
+    assert backend.hedge_delay_s == 3.0
+    backend.ttfts.extend([0.01] * 50)  # Window of 50: the slow ones age out
+    assert backend.hedge_delay_s == 0.1
+
+
+# --- Quotas ---
+
+def drained(requests_per_min):
+    """A scheduler whose request budget is used up, so the next request waits 60 / requests_per_min s."""
+    scheduler = QuotaScheduler(requests_per_min, 0)
+    scheduler.requests.take(requests_per_min)
+    return scheduler
+
+
+def test_zero_capacity_bucket_is_unlimited():
+    bucket = TokenBucket(0)
+    assert bucket.wait_time(10 ** 9) == 0.0
+    bucket.take(10 ** 9)
+    assert bucket.available == float("inf")
+
+
+def test_zero_token_quota_turns_the_token_limit_off():
+    scheduler = QuotaScheduler(10, 0)
+    backend = ResilientBackend(MockBackend(latency_s=0), scheduler=scheduler)
+    assert asyncio.run(backend.complete(HI))
+    assert scheduler.granted == 1
+
+
+def test_interactive_requests_are_served_before_background_ones():
+    clock = FakeClock()
+    scheduler = QuotaScheduler(1, 0, clock=clock)
+    order = []
+
+    async def request(label, priority):
+        await scheduler.acquire(1, priority)
+        order.append(label)
+
+    async def run():
+        await request("first", INTERACTIVE)  # Uses up the only request this minute
+        waiting = [
+            asyncio.ensure_future(request("summary", BACKGROUND)),
+            asyncio.ensure_future(request("chat", INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        assert order == ["first"]
+        for _ in range(2):
+            clock.now += 60.0
+            scheduler._dispatch()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiting)
+
+    asyncio.run(run())
+    assert order == ["first", "chat", "summary"]
+    assert scheduler.throttled == 2
+
+
+def test_waiters_that_give_up_still_count_as_throttled():
+    scheduler = drained(1)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire(1), 0.05)
+
+    asyncio.run(run())
+    assert scheduler.throttled == 1 and scheduler.granted == 0
+    assert scheduler.stats()["waiting"] == 0
+
+
+def test_queueing_for_quota_is_not_taken_for_a_slow_model():
+    scheduler = drained(120)  # Next request in 0.5 s
+    breaker = CircuitBreaker(failure_threshold=1)
+    backend = ResilientBackend(
+        MockBackend(latency_s=0), attempt_timeout_s=0.2, breaker=breaker, scheduler=scheduler,
+    )
+    assert asyncio.run(backend.complete(HI))
+    assert breaker.failures == 0 and backend.retries == 0
+    assert scheduler.throttled == 1 and scheduler.granted == 1
+
+
+def test_running_out_of_quota_hits_the_deadline_without_tripping_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1)
+    mock = MockBackend(latency_s=0)
+    backend = ResilientBackend(mock, deadline_s=0.1, breaker=breaker, scheduler=drained(1))
+    with pytest.raises(ChatTimeout, match="quota"):
+        asyncio.run(backend.complete(HI))
+    assert breaker.state == "closed" and mock.requests == 0
+
+
+def test_hedged_requests_are_charged_to_the_quota():
+    scheduler = QuotaScheduler(100, 0)
+    backend = ResilientBackend(
+        HedgedBackend(named("slow", 1.0), named("fast", 0.0), initial_delay_s=0.05, scheduler=scheduler),
+        scheduler=scheduler,
+    )
+    asyncio.run(backend.complete(HI))
+    assert scheduler.granted == 2
+
+
+def test_queueing_for_quota_does_not_trigger_a_hedge():
+    scheduler = drained(120)  # Next request in 0.5 s, well past the hedge delay
+    hedged = HedgedBackend(named("primary", 0.0), named("secondary", 0.0), initial_delay_s=0.1, scheduler=scheduler)
+    asyncio.run(ResilientBackend(hedged, scheduler=scheduler).complete(HI))
+    assert hedged.hedged == 0
+    assert hedged.ttfts[0] < 0.1
+
+
+# --- RoutedBackend ---
+
+def test_small_talk_never_goes_to_the_strong_model():
+    strong = named("strong", 0.0)
+    backend = RoutedBackend([named("a", 0.01), named("b", 0.02)], strong, min_samples=2)
+
+    async def run():
+        for _ in range(8):
+            await backend.complete(HI)
+        await backend.complete([{"role": "user", "parts": ["explain this step by step"]}])
+
+    asyncio.run(run())
+    assert backend.routed["strong"] == 1
+    assert backend.last_route["reason"] == "long or complex prompt"
+    assert backend.routed["a"] > backend.routed["b"]
+
+
+def test_a_hung_model_stops_getting_traffic_under_resilient_backend():
+    router = RoutedBackend([named("hung", 5.0), named("ok", 0.0)], named("strong", 0.0), slo_ttft_s=0.05,
+                           min_samples=2)
+    backend = ResilientBackend(router, attempt_timeout_s=0.1, max_attempts=1)
+
+    async def run():
+        for _ in range(6):
+            try:
+                await backend.complete(HI)
+            except ChatTimeout:
+                pass
+
+    asyncio.run(run())
+    assert router.routed["hung"] == 2  # Only while gathering statistics
+    assert router.latency["hung"].snapshot()["error rate"] == 1.0
+    assert router.last_route["reason"].startswith("fastest healthy")
+    assert router.last_route["backend"] == "ok"
+
+
+def test_a_stream_cancelled_within_the_slo_is_not_recorded():
+    router = RoutedBackend([named("slow", 5.0)], named("strong", 0.0), slo_ttft_s=1.0)
+    backend = ResilientBackend(router, attempt_timeout_s=0.1, max_attempts=1)
+    with pytest.raises(ChatTimeout):
+        asyncio.run(backend.complete(HI))
+    assert len(router.latency["slow"]) == 0
+
+
+def test_requests_in_flight_count_towards_min_samples():
+    router = RoutedBackend([named("a", 0.2), named("b", 0.2)], named("strong", 0.0), min_samples=1)
+
+    async def run():
+        await asyncio.gather(router.complete(HI), router.complete(HI))
+
+    asyncio.run(run())
+    assert router.routed["a"] == router.routed["b"] == 1
+
+
+def test_reading_available_does_not_change_the_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock)
+    bucket.take(60)
+    clock.now += 30
+    level, last = bucket.level, bucket._last
+    assert bucket.available == 30
+    assert (bucket.level, bucket._last) == (level, last)
+
+
+# --- KeyPoolBackend ---
+
+def test_key_pool_spreads_requests_by_budget_left():
+    keys = [MockBackend(latency_s=0, tokens_per_s=10000), MockBackend(latency_s=0, tokens_per_s=10000)]
+    pool = KeyPoolBackend(keys, requests_per_min=10, clock=FakeClock())
+    for _ in range(4):
+        pool.complete_sync(HI)
+    assert keys[0].requests == keys[1].requests == 2
+
+
+def test_rate_limited_key_cools_down_and_traffic_fails_over():
+    clock = FakeClock()
+    limited, spare = failing(429), MockBackend(latency_s=0, tokens_per_s=10000)
+    pool = KeyPoolBackend([limited, spare], requests_per_min=10, cooldown_s=30.0, cooldown_cap_s=100.0, clock=clock)
+    with pytest.raises(MockBackendError):
+        pool.complete_sync(HI)
+    assert pool.keys[0].cooling_down
+    for _ in range(3):
+        pool.complete_sync(HI)
+    assert limited.requests == 1 and spare.requests == 3
+
+    clock.now += 30.0
+    with pytest.raises(MockBackendError):
+        pool.complete_sync(HI)  # Back in rotation, limited again: twice as long this time
+    assert pool.keys[0].cooldown_s == 60.0 and pool.keys[0].rate_limited == 2
+    clock.now += 59.0
+    assert pool.keys[0].cooling_down
+
+
+def test_pool_with_every_key_cooling_down_fails_fast_and_retryably():
+    pool = KeyPoolBackend([failing(429)], clock=FakeClock())
+    with pytest.raises(MockBackendError):
+        pool.complete_sync(HI)
+    with pytest.raises(KeyPoolError) as error:
+        pool.complete_sync(HI)
+    assert status_code(error.value) == 429
+
+
+def test_a_successful_request_resets_the_cooldown():
+    clock = FakeClock()
+    mock = MockBackend(latency_s=0, reply_tokens=4, chunk_tokens=4, error_rate=1.0, error_code=429, seed=1)
+    pool = KeyPoolBackend([mock], cooldown_s=10.0, clock=clock)
+    with pytest.raises(MockBackendError):
+        pool.complete_sync(HI)
+    clock.now += 10.0
+    mock.error_rate = 0.0
+    pool.complete_sync(HI)
+    assert pool.keys[0].cooldown_s == 0.0